@@ -9,6 +9,7 @@ warnings.filterwarnings("ignore", category=UserWarning)
 
 import numpy as np
 from dotmap import DotMap
+from functools import lru_cache
 
 import mujoco_py
 import torch
@@ -27,6 +28,7 @@ from plot import plot_cp, plot_loss, setup_plotting
 
 from dynamics_model import DynamicsModel
 from reacher_pd import run_controller
+from trajectory_store import TrajectoryList, TrajectoryWriter
 
 
 ###########################################
@@ -115,16 +117,106 @@ def create_dataset_step(data, delta=True, t_range=0, is_lstm = False, lstm_batch
     return data_in, data_out
 
 
-def collect_data_lqr(cfg, plot=False):  # Creates horizon^2/2 points
+def cartpole_lqr_system(env):
     """
-    Collect data for environment model
+    Continuous time linearization of the cart-pole around the upright equilibrium with the LQR weights
+    used for data collection
+    :return: A, B, Q, R for policy.LQR
+    """
+    m_c = env.masscart
+    m_p = env.masspole
+    m_t = m_c + m_p
+    g = env.gravity
+    l = env.length
+    A = np.array([
+        [0, 1, 0, 0],
+        [0, g * m_p / m_c, 0, 0],
+        [0, 0, 0, 1],
+        [0, 0, g * m_t / (l * m_c), 0],
+    ])
+
+    B = np.array([
+        [0, 1 / m_c, 0, -1 / (l * m_c)],
+    ])
+
+    Q = np.diag([.5, .05, 1, .05])
+
+    R = np.ones(1)
+    return A, B.transpose(), Q, R
+
+
+@lru_cache(maxsize=None)
+def _lqr_gain(masscart, masspole, gravity, length):
+    env = DotMap(masscart=masscart, masspole=masspole, gravity=gravity, length=length)
+    return np.asarray(LQR(*cartpole_lqr_system(env)).K)
+
+
+def lqr_gain(env):
+    """
+    Nominal LQR gain of the cart-pole, the Riccati equation is only solved once for a set of env constants
+    :return: 1 x 4 gain, a copy that can be modified
+    """
+    return np.array(_lqr_gain(env.masscart, env.masspole, env.gravity, env.length))
+
+
+def sample_modifiers(data_mode, size=4, rng=np.random):
+    """
+    Random elementwise multipliers of the LQR gain, their range sets how stable the collected trajectories are
+    :param size: 4 for one gain, (M, 4) for M gains
+    :param rng: the random state drawn from (np.random or a RandomState)
+    """
+    if data_mode == 'chaotic':
+        return .75 * rng.random_sample(size)
+    elif data_mode == 'unstable':
+        return 1.5 * rng.random_sample(size) - .75
+    else:
+        return .5 * rng.random_sample(size) + 1
+
+
+def set_thresholds(env, data_mode):
+    """
+    Termination thresholds of a fresh env for data_mode, unstable trajectories may go twice as far
+    """
+    if data_mode == 'unstable':
+        # default 2.4
+        env.x_threshold = 2 * env.x_threshold
+        env.theta_threshold_radians = 2 * env.theta_threshold_radians
+    return env
+
+
+def trial_seeds(s, pending, cfg):
+    """
+    Seeds of the first attempt of each pending trial, s + i + k for the k-th pending trial i (two apart when
+    collecting from scratch)
+    """
+    pending = np.asarray(pending, dtype=int)
+    return [0] * len(pending) if cfg.PID_test else list(s + pending + np.arange(len(pending)))
+
+
+def retry_seeds(s, cfg, start, n):
+    """
+    Seeds of retry candidates start..start + n - 1. Retries draw from their own stream, after the seeds of the
+    first attempts, with modifiers from np.random.RandomState(s), so a batch that simulates more candidates than
+    it needs leaves np.random untouched
+    """
+    return list(s + 2 * cfg.num_trials + start + np.arange(n))
+
+
+def collect_data_lqr(cfg, plot=False, writer=None):  # Creates horizon^2/2 points
+    """
+    Collect data for environment model. Every pending trial is run once with its own seed, trials that terminate
+    before cfg.trial_timesteps are then redone in order with candidates of the retry stream (see retry_seeds)
+    until one completes. collect_data_lqr_batch collects the same trajectories.
     :param nTrials:
     :param horizon:
+    :param writer: a trajectory_store.TrajectoryWriter every finished trajectory is written to as it
+                   finishes, so an interrupted run can resume: trials already in it are skipped. The returned
+                   trajectories are still read back into memory
     :return: an array of DotMaps, where each DotMap contains info about a trajectory
     """
 
     env_model = cfg.env.name
-    env = gym.make(env_model)
+    env = set_thresholds(gym.make(env_model), cfg.data_mode)
     # if (cfg.video):
     # env = Monitor(env, hydra.utils.get_original_cwd() + '/trajectories/reacher/video',
     # video_callable = lambda episode_id: episode_id==1,force=True)
@@ -132,84 +224,170 @@ def collect_data_lqr(cfg, plot=False):  # Creates horizon^2/2 points
 
     # Logs is an array of dotmaps, each dotmap contains 2d np arrays with data
     # about <horizon> steps with actions, rewards and states
-    logs = []
-    if (cfg.PID_test):
-        target = np.random.rand(5) * 2 - 1
+    logs = writer if writer is not None else TrajectoryList()
+
+    A, B, Q, R = cartpole_lqr_system(env)
+    K = lqr_gain(env)
+    lim = cfg.trial_timesteps
+
+    def run(seed, modifier):
+        env.seed(seed)
+        env.reset()
+        policy = LQR(A, B, Q, R, actionBounds=[-1.0, 1.0], K=np.multiply(K, modifier))
+        dotmap = run_controller(env, horizon=cfg.trial_timesteps, policy=policy, video=cfg.video)
+        dotmap.K = np.array(policy.K).flatten()
+        return dotmap
+
+    def save(i, dotmap):
+        if plot: plot_cp(dotmap.states, dotmap.actions, save=True)
+        logs.append(i, dotmap)
 
     s = np.random.randint(0, 100)
-    for i in range(cfg.num_trials):
+    pending = [i for i in range(cfg.num_trials) if i not in logs.trials]
+    failed = []
+    for i, seed in zip(pending, trial_seeds(s, pending, cfg)):
         log.info('Trial %d' % i)
-        if (cfg.PID_test):
-            env.seed(0)
+        dotmap = run(seed, sample_modifiers(cfg.data_mode))
+        if len(dotmap.states) < lim:
+            failed.append(i)
         else:
-            env.seed(s + i)
-        s0 = env.reset()
-
-        m_c = env.masscart
-        m_p = env.masspole
-        m_t = m_c + m_p
-        g = env.gravity
-        l = env.length
-        A = np.array([
-            [0, 1, 0, 0],
-            [0, g * m_p / m_c, 0, 0],
-            [0, 0, 0, 1],
-            [0, 0, g * m_t / (l * m_c), 0],
-        ])
-
-        B = np.array([
-            [0, 1 / m_c, 0, -1 / (l * m_c)],
-        ])
-
-        Q = np.diag([.5, .05, 1, .05])
-
-        R = np.ones(1)
-
-        n_dof = np.shape(A)[0]
-        if cfg.data_mode == 'chaotic':
-            modifier = .75 * np.random.random(4)
-            lim = cfg.trial_timesteps
-        elif cfg.data_mode == 'unstable':
-            modifier = 1.5 * np.random.random(4) - .75
-            env.theta_threshold_radians = 2 * env.theta_threshold_radians
-            # default 2.4
-            env.x_threshold = 2 * env.x_threshold
-            lim = cfg.trial_timesteps
-        else:
-            modifier = .5 * np.random.random(4) + 1
-            lim = cfg.trial_timesteps
-        policy = LQR(A, B.transpose(), Q, R, actionBounds=[-1.0, 1.0])
-        policy.K = np.multiply(policy.K, modifier)
-        # print(type(env))
-        dotmap = run_controller(env, horizon=cfg.trial_timesteps, policy=policy, video=cfg.video)
+            save(i, dotmap)
+
+    retry_rng = np.random.RandomState(s)
+    r = 0
+    for i in failed:
+        dotmap = DotMap(states=[])
         while len(dotmap.states) < lim:
-            env.seed(s)
-            env.reset()
-            if cfg.data_mode == 'chaotic':
-                modifier = .75 * np.random.random(4)
-            elif cfg.data_mode == 'unstable':
-                modifier = 1.5 * np.random.random(4) - .75
-                env.theta_threshold_radians = 2 * env.theta_threshold_radians
-                # default 2.4
-                env.x_threshold = 2 * env.x_threshold
-            else:
-                modifier = .5 * np.random.random(4) + 1
-            policy = LQR(A, B.transpose(), Q, R, actionBounds=[-1.0, 1.0])
-            policy.K = np.multiply(policy.K, modifier)
-            dotmap = run_controller(env, horizon=cfg.trial_timesteps, policy=policy, video=cfg.video)
             print(f"- Repeat simulation")
-            s += 1
-            # if plot and len(dotmap.states)>0: plot_cp(dotmap.states, dotmap.actions)
+            dotmap = run(retry_seeds(s, cfg, r, 1)[0], sample_modifiers(cfg.data_mode, 4, retry_rng))
+            r += 1
+        save(i, dotmap)
 
-        if plot: plot_cp(dotmap.states, dotmap.actions, save=True)
+    return logs.read()
 
-        dotmap.K = np.array(policy.K).flatten()
-        logs.append(dotmap)
-        s += 1
 
+def run_controller_batch(env, horizon, policy):
+    """
+    run_controller for a batch environment, the M rows of env are stepped together with a batch policy
+    (e.g. policy.BatchLQR) until every row is done or horizon is reached
+
+    :return: a DotMap with M x horizon states, actions and rewards, and lengths, the number of steps of each
+             row before it terminated (like run_controller, the terminating step is not counted)
+    """
+    observation = env.reset()
+    M = env.num_envs
+    logs = DotMap()
+    logs.states = np.zeros((M, horizon, np.shape(observation)[1]))
+    logs.actions = np.zeros((M, horizon))
+    logs.rewards = np.zeros((M, horizon))
+    logs.lengths = np.full(M, horizon)
+    for i in range(horizon):
+        action, t = policy.act(observation)
+        observation, reward, done, info = env.step(action)
+        logs.lengths[done & (logs.lengths == horizon)] = i
+        if np.all(done):
+            break
+        logs.actions[:, i] = action[:, 0]
+        logs.rewards[:, i] = reward
+        logs.states[:, i] = observation
     return logs
 
 
+def collect_data_lqr_batch(cfg, plot=False, writer=None, max_batch=10000):
+    """
+    collect_data_lqr with all trials simulated together in a BatchCartPoleContEnv. Trials that terminate
+    before cfg.trial_timesteps are replaced by rejection sampling: each retry round simulates a batch of
+    candidates of the retry stream, oversampled by the acceptance rate of the previous round, and the first
+    complete candidates fill the pending trials in order. Seeds, modifiers and initial states are drawn as in
+    collect_data_lqr, so both collect the same trajectories.
+    :param max_batch: cap on the candidates simulated per retry round
+    :param writer: see collect_data_lqr
+    :return: an array of DotMaps, where each DotMap contains info about a trajectory
+    """
+    from envs.cartpole import BatchCartPoleContEnv
+    from policy import BatchLQR
+
+    horizon = cfg.trial_timesteps
+    K = lqr_gain(BatchCartPoleContEnv(1))
+    log.info('Initializing batch env: %s x %d' % (cfg.env.name, cfg.num_trials))
+
+    def simulate(seeds, modifiers):
+        env = set_thresholds(BatchCartPoleContEnv(len(seeds)), cfg.data_mode)
+        env.seed(seeds)
+        # run_controller_batch resets again, every row starts from the second draw as in collect_data_lqr
+        env.reset()
+        gains = np.multiply(K, modifiers)
+        batch = run_controller_batch(env, horizon, BatchLQR(gains, actionBounds=[-1.0, 1.0]))
+        complete = np.where(batch.lengths == horizon)[0]
+        return batch, gains, complete
+
+    def save(i, batch, gains, m):
+        dotmap = DotMap()
+        dotmap.states = batch.states[m]
+        dotmap.actions = batch.actions[m]
+        dotmap.rewards = batch.rewards[m]
+        dotmap.K = gains[m]
+        logs.append(i, dotmap)
+        if plot: plot_cp(dotmap.states, dotmap.actions, save=True)
+
+    logs = writer if writer is not None else TrajectoryList()
+    pending = np.array([i for i in range(cfg.num_trials) if i not in logs.trials], dtype=int)
+    s = np.random.randint(0, 100)
+    if not len(pending):
+        return logs.read()
+
+    # the first round runs every trial with its own seed
+    batch, gains, complete = simulate(trial_seeds(s, pending, cfg), sample_modifiers(cfg.data_mode, (len(pending), 4)))
+    for m in complete:
+        save(pending[m], batch, gains, m)
+    rate = max(len(complete), 1) / len(pending)
+    pending = np.delete(pending, complete)
+
+    retry_rng = np.random.RandomState(s)
+    r = 0
+    while len(pending):
+        # oversample the round so it is likely to fill every pending trial
+        n = int(min(np.ceil(len(pending) / rate), max_batch))
+        log.info(f"- Repeat simulation of {len(pending)} trials with {n} candidates")
+        batch, gains, complete = simulate(retry_seeds(s, cfg, r, n),
+                                          sample_modifiers(cfg.data_mode, (n, 4), retry_rng))
+        # complete candidates beyond the pending trials are dropped
+        used = complete[:len(pending)]
+        for i, m in zip(pending, used):
+            save(i, batch, gains, m)
+        r += n
+        pending = pending[len(used):]
+        rate = max(len(complete), 1) / n
+
+    return logs.read()
+
+
+def linearize_model(model, x0, u0):
+    """
+    Linearizes a learned one-step model around operating points, x_{t+1} ~ A x_t + B u_t
+    :param model: a one-step DynamicsModel
+    :param x0: N x 4 states (or a single state)
+    :param u0: N x 1 actions (or a single action)
+    :return: A (N x 4 x 4) and B (N x 4 x 1) discrete time matrices
+    """
+    x = np.hstack((np.atleast_2d(x0), np.reshape(u0, (np.shape(np.atleast_2d(x0))[0], -1))))
+    jac = model.jacobian(x, wrt=None).detach().numpy()
+    n_state = len(model.state_indices)
+    return jac[:, :, :n_state], jac[:, :, n_state:]
+
+
+def learned_lqr_gain(model, Q=np.diag([.5, .05, 1, .05]), R=np.ones((1, 1)), x0=np.zeros(4), u0=np.zeros(1)):
+    """
+    Discrete time LQR gain for a learned one-step model linearized at (x0, u0), an alternative to the
+    hand written continuous A, B matrices in collect_data_lqr. Use as policy.K = learned_lqr_gain(model)
+    """
+    from scipy.linalg import solve_discrete_are
+    A, B = linearize_model(model, x0, u0)
+    A, B = A[0], B[0]
+    S = solve_discrete_are(A, B, Q, R)
+    return np.linalg.solve(R + B.T @ S @ B, B.T @ S @ A)
+
+
 ###########################################
 #           Plotting / Output             #
 ###########################################
@@ -236,12 +414,18 @@ def contpred(cfg):
     if not train:
         log.info(f"Collecting new trials")
 
-        exper_data = collect_data_lqr(cfg, plot=cfg.plot)
-        test_data = collect_data_lqr(cfg, plot=cfg.plot)
+        collect = collect_data_lqr_batch if cfg.batch and not cfg.video else collect_data_lqr
+        f = hydra.utils.get_original_cwd() + '/trajectories/cartpole/' + 'raw' + cfg.data_dir
+        writers = [TrajectoryWriter(f + split, resume=cfg.resume) for split in ('.exper', '.test')]
+        log.info(f"Streaming trajectories to {f}.exper and {f}.test")
+        exper_data = collect(cfg, plot=cfg.plot, writer=writers[0])
+        test_data = collect(cfg, plot=cfg.plot, writer=writers[1])
+        [w.close() for w in writers]
 
         log.info("Saving new default data")
-        torch.save((exper_data, test_data),
-                   hydra.utils.get_original_cwd() + '/trajectories/cartpole/' + 'raw' + cfg.data_dir)
+        torch.save((exper_data, test_data), f)
+        # the saved file replaces the stores of this collection
+        [w.remove() for w in writers]
         log.info(f"Saved trajectories to {'/trajectories/cartpole/' + 'raw' + cfg.data_dir}")
     # Load data
     else:
@@ -281,6 +465,12 @@ def contpred(cfg):
 
             model = DynamicsModel(cfg)
             train_logs, test_logs = model.train(dataset, cfg)
+            if traj and cfg.model.training.get('reward_head', False):
+                from reward_rank import create_dataset_reward
+                log.info("Training reward head")
+                model.train_reward(create_dataset_reward(exper_data, cfg.env.label, model,
+                                                         threshold=cfg.model.training.filter_rate,
+                                                         t_range=cfg.model.training.t_range), cfg)
 
             setup_plotting({cfg.model.str: model})
             plot_loss(train_logs, test_logs, cfg, save_loc=cfg.env.name + '-' + cfg.model.str, show=False)
@@ -0,0 +1,190 @@
+"""
+The purpose of this file is to tune controller parameters with a trajectory-based model instead of simulating.
+A trajectory model predicts the state at any time index from the initial state and the control parameters, so
+the full predicted trajectory of thousands of candidate parameters can be scored in one batched call.
+"""
+
+import sys
+
+import hydra
+import logging
+
+import torch
+import numpy as np
+from timeit import default_timer as timer
+
+from reward_rank import reward_function, traj_params
+
+log = logging.getLogger(__name__)
+
+
+def param_bounds(model):
+    """
+    Box constraints on the control parameters, taken from the range of the parameters the trajectory model
+    was trained on (the collection ranges, e.g. P in [0, 5]/5 and D in [0, 1] for the reacher)
+    """
+    scaler = model.nets[0].paramScaler
+    if not hasattr(scaler, 'data_min_'):
+        raise ValueError("Parameter bounds need a MinMaxScaler for the parameters")
+    return np.array(scaler.data_min_), np.array(scaler.data_max_)
+
+
+def predict_trajectories(model, initial, params, horizon):
+    """
+    Predicts the trajectories of C candidate control parameters from one initial state with a single model call
+    :return: C x (horizon + 1) x D predicted states, starting with the initial state
+    """
+    params = np.atleast_2d(params)
+    pred = model.predict(model.traj_input(initial, params, horizon)).detach().numpy()
+    pred = pred.reshape((len(params), horizon, -1))
+    s0 = np.broadcast_to(initial, (len(params), 1, np.shape(pred)[2]))
+    return np.concatenate((s0, pred), axis=1)
+
+
+def predict_returns(model, initial, params, horizon, r_func, reward_head=False):
+    """
+    Predicted return of C candidate control parameters from one initial state (the initial state included).
+    With reward_head the model's reward head gives each return in a single forward pass per candidate,
+    otherwise the reward is summed over the predicted trajectories
+    """
+    if not reward_head:
+        return np.sum(r_func(predict_trajectories(model, initial, params, horizon)), axis=1)
+    params = np.atleast_2d(params)
+    x = np.hstack((np.tile(initial, (len(params), 1)), np.full((len(params), 1), horizon), params))
+    return r_func(np.atleast_2d(initial))[0] + model.predict_reward(x).detach().numpy()
+
+
+def optimize_params(model, initial, r_func, horizon, bounds, method='cem', population=2000, elites=100,
+                    iterations=5, alpha=0.1, reward_head=False):
+    """
+    Sampling based search over control parameters of a trajectory model.
+
+    Parameters:
+        model: trajectory DynamicsModel trained with control parameters
+        initial: the initial state (in model.state_indices)
+        r_func: array reward function over (..., D) states, see reward_rank.reward_function
+        horizon: number of timesteps to predict and sum the reward over
+        bounds: (low, high) arrays for the parameters, see param_bounds
+        method: 'cem' refits a diagonal Gaussian to the elites every iteration,
+                'random' is random shooting with uniform samples every iteration
+        population: number of candidates evaluated per iteration (one batched model call)
+        elites: number of best candidates the CEM distribution is fit to
+        alpha: smoothing of the CEM distribution, the weight kept on the previous mean and std
+        reward_head: score candidates with the model's reward head instead of the predicted trajectories
+
+    Returns:
+        best: the best parameters found
+        best_return: its predicted cumulative reward
+        history: the mean predicted return of the elites at each iteration
+    """
+    if method not in ('cem', 'random'):
+        raise ValueError("Invalid method: " + str(method))
+    low, high = bounds
+    mean = (low + high) / 2
+    std = (high - low) / 2
+    best, best_return = None, -np.inf
+    history = []
+    for it in range(iterations):
+        if method == 'random':
+            candidates = np.random.uniform(low, high, size=(population, len(low)))
+        else:
+            candidates = np.clip(mean + std * np.random.randn(population, len(low)), low, high)
+        returns = predict_returns(model, initial, candidates, horizon, r_func, reward_head)
+
+        order = np.argsort(returns)[::-1][:elites]
+        if returns[order[0]] > best_return:
+            best, best_return = candidates[order[0]], returns[order[0]]
+        elite = candidates[order]
+        mean = alpha * mean + (1 - alpha) * np.mean(elite, axis=0)
+        std = alpha * std + (1 - alpha) * np.std(elite, axis=0)
+        history.append(np.mean(returns[order]))
+    return best, best_return, history
+
+
+def gradient_optimize(model, initial, r_func, horizon, bounds, restarts=64, steps=100, lr=0.05):
+    """
+    Gradient based search over control parameters of a trajectory model. The initial state is fixed and the
+    reward summed over the predicted horizon is backpropagated through the model into the parameters,
+    normalized to [0, 1] within bounds. All restarts are optimized in parallel as one batch and projected back
+    into the box after every Adam step.
+
+    Parameters:
+        r_func: differentiable array reward function, see reward_rank.reward_function
+        restarts: number of random initial parameters optimized in parallel
+        steps: number of gradient steps, so restarts * steps trajectories are predicted in total
+
+    Returns:
+        best: the best parameters found
+        best_return: its predicted cumulative reward
+        history: the mean predicted return over the restarts at each step
+    """
+    low, high = (torch.from_numpy(np.float32(b)) for b in bounds)
+    n_params = len(low)
+    x = torch.from_numpy(np.float32(model.traj_input(initial, np.zeros((restarts, n_params)), horizon)))
+    x = x[:, :-n_params]
+    v = torch.rand((restarts, n_params), requires_grad=True)
+    optimizer = torch.optim.Adam([v], lr=lr)
+
+    best, best_return = None, -np.inf
+    history = []
+    for step in range(steps):
+        optimizer.zero_grad()
+        params = low + v * (high - low)
+        pred = model.fused_predict(torch.cat((x, params.repeat_interleave(horizon, dim=0)), dim=1))
+        returns = torch.sum(r_func(pred.view(restarts, horizon, -1)), dim=1)
+        (-returns.sum()).backward()
+
+        i = torch.argmax(returns).item()
+        if returns[i].item() > best_return:
+            best, best_return = params[i].detach().numpy(), returns[i].item()
+        history.append(returns.mean().item())
+
+        optimizer.step()
+        with torch.no_grad():
+            v.clamp_(0, 1)
+
+    # the initial state is part of the trajectory scored by optimize_params
+    best_return += np.sum(r_func(np.atleast_2d(initial)))
+    return best, best_return, history
+
+
+@hydra.main(config_path='conf/control_opt.yaml')
+def control_opt(cfg):
+    label = cfg.env.label
+
+    log.info(f"Loading default data")
+    (_, test_data) = torch.load(hydra.utils.get_original_cwd() + '/trajectories/' + label + '/raw' + cfg.data_dir)
+
+    f = hydra.utils.get_original_cwd() + '/models/' + label + '/'
+    if cfg.exper_dir:
+        f = f + cfg.exper_dir + '/'
+    model = torch.load(f + cfg.traj_model + '.dat')
+    if not model.traj:
+        raise ValueError("Controller optimization needs a trajectory model")
+    if cfg.reward_head and getattr(model, 'reward_net', None) is None:
+        raise ValueError("Model has no reward head, train with model.training.reward_head=true")
+
+    # the predicted states are laid out as the model's state_indices
+    r_func = reward_function(label, model.state_indices)
+    bounds = param_bounds(model)
+    for i, traj in enumerate(test_data[:cfg.num_initials]):
+        initial = traj.states[0, model.state_indices]
+        start = timer()
+        if cfg.optimizer.method == 'gradient':
+            best, best_return, history = gradient_optimize(model, initial, r_func, cfg.horizon, bounds,
+                                                           **cfg.gradient)
+            evals = cfg.gradient.restarts * cfg.gradient.steps
+        else:
+            best, best_return, history = optimize_params(model, initial, r_func, cfg.horizon, bounds,
+                                                         reward_head=cfg.reward_head, **cfg.optimizer)
+            evals = cfg.optimizer.population * cfg.optimizer.iterations
+        end = timer()
+        recorded = predict_trajectories(model, initial, traj_params(traj, label, model), cfg.horizon)
+        log.info(f"Initial state {i}: optimized in {end - start:.2f}s ({evals} predicted trajectories), "
+                 f"returns {np.round(history[-5:], 3)}")
+        log.info(f" - best parameters {np.round(best, 3)}, predicted return {best_return:.3f}")
+        log.info(f" - recorded parameters predicted return {np.sum(r_func(recorded)):.3f}")
+
+
+if __name__ == '__main__':
+    sys.exit(control_opt())
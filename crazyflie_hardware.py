@@ -1,6 +1,7 @@
 import sys
 import warnings
 import os
+import shutil
 
 import matplotlib.cbook
 
@@ -8,6 +9,7 @@ warnings.filterwarnings("ignore", category=matplotlib.cbook.mplDeprecation)
 warnings.filterwarnings("ignore", category=UserWarning)
 
 import numpy as np
+import hashlib
 
 import torch
 
@@ -45,6 +47,77 @@ def convert_pwm(packed_pwm):
     return ret
 
 
+def unpack_pwms(packed):
+    """
+    convert_pwm for a whole column, unpacks the four 8 bit motor commands of every packed PWM word at once
+    :param packed: N (or N x 1) packed PWM words
+    :return: N x 4 PWMs
+    """
+    packed = np.asarray(packed, dtype=np.int64).reshape(-1, 1)
+    return (((packed >> np.array([0, 8, 16, 24])) & 0xFF) << 8).astype(float)
+
+
+def file_sha1(path, block=1 << 20):
+    sha1 = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(block), b''):
+            sha1.update(chunk)
+    return sha1.hexdigest()
+
+
+def cached_sha1(path, stamp):
+    """
+    file_sha1 of path, remembered in the file stamp together with the size and modification time of path. The file
+    is only hashed again when its size or modification time changed
+    """
+    st = os.stat(path)
+    key = '%d %d' % (st.st_size, st.st_mtime_ns)
+    if os.path.exists(stamp):
+        with open(stamp) as f:
+            saved = f.read().split()
+        if len(saved) == 3 and ' '.join(saved[:2]) == key:
+            return saved[2]
+    sha1 = file_sha1(path)
+    os.makedirs(os.path.dirname(stamp), exist_ok=True)
+    with open(stamp, 'w') as f:
+        f.write('%s %s\n' % (key, sha1))
+    return sha1
+
+
+def load_log(path, cache=True):
+    """
+    Loads the numeric columns of a hardware log CSV. The first load converts them to a columnar cache of npy files
+    in path.cache/<SHA-1 of the CSV>/, later loads of the same file memory map the cached columns instead of
+    parsing the CSV again (an edited CSV gets a new cache, which replaces the caches of its earlier versions). The
+    SHA-1 is kept in path.cache/stamp.txt and only recomputed when the size or modification time of the CSV changes
+    :return: a dict from column name to array
+    """
+    if cache:
+        cache_dir = os.path.join(path + '.cache', cached_sha1(path, os.path.join(path + '.cache', 'stamp.txt')))
+        index = os.path.join(cache_dir, 'columns.txt')
+        if os.path.exists(index):
+            with open(index) as f:
+                names = f.read().splitlines()
+            return {name: np.load(os.path.join(cache_dir, '%d.npy' % i), mmap_mode='r')
+                    for i, name in enumerate(names)}
+
+    import pandas as pd
+    df = pd.read_csv(path, error_bad_lines=False, delimiter=',')
+    columns = {name: df[name].to_numpy() for name in df.columns if pd.api.types.is_numeric_dtype(df[name])}
+    if cache:
+        os.makedirs(cache_dir, exist_ok=True)
+        for i, column in enumerate(columns.values()):
+            np.save(os.path.join(cache_dir, '%d.npy' % i), column)
+        # the column list is written last, so an interrupted conversion is redone
+        with open(index, 'w') as f:
+            f.write('\n'.join(columns) + '\n')
+        # caches of earlier versions of the file
+        for name in os.listdir(path + '.cache'):
+            if name not in (os.path.basename(cache_dir), 'stamp.txt'):
+                shutil.rmtree(os.path.join(path + '.cache', name), ignore_errors=True)
+    return columns
+
+
 def create_dataset_traj(data, control_params=False, train_target=True, threshold=0.0, delta=False, t_range=0):
     """
     Creates a dataset with entries for PID parameters and number of
@@ -131,26 +204,85 @@ def log_hyperparams(cfg):
 #             Main Functions              #
 ###########################################
 
-def get_datasets(df):
+def strided_windows(data, length, stride):
+    """
+    Every window of length rows starting each stride rows of data, as a read only view of data (nothing is copied)
+    :param data: N x D array
+    :return: K x length x D view, only complete windows
+    """
+    k = (len(data) - length) // stride + 1 if len(data) >= length else 0
+    return np.lib.stride_tricks.as_strided(data, shape=(k, length, data.shape[1]),
+                                           strides=(stride * data.strides[0],) + data.strides, writeable=False)
+
+
+def window_trajectories(windows, state_dim=3):
+    """
+    Splits a batch of windows of states and actions into (states, actions, deltas) trajectories, the last row of a
+    window is only used for the deltas. States and actions stay views of the windows, the deltas are computed here
+    for the whole batch at once
+    :param windows: K x (l + 2) x (state_dim + action_dim) windows, e.g. from strided_windows
+    :return: list of K (states, actions, deltas) of l + 1 rows each
+    """
+    states = windows[:, :-1, :state_dim]
+    actions = windows[:, :-1, state_dim:]
+    deltas = windows[:, 1:, :state_dim] - states
+    return list(zip(states, actions, deltas))
+
+
+def log_rows(df):
+    """
+    :param df: the log columns, a DataFrame or the dict of load_log
+    :return: N x 7 array of the roll, pitch, yaw states and the four unpacked PWMs
+    """
+    states = np.stack([df['roll'], df['pitch'], df['yaw']], axis=1)
+    return np.hstack((states, unpack_pwms(df['pwms'])))
+
+
+def stream_windows(path, length=1000, stride=None, start=150, chunksize=100000):
+    """
+    Reads a hardware log CSV in chunks and yields the trajectories of get_datasets as soon as their rows are read, so
+    parsing never holds the whole log. Rows are appended to a buffer which only keeps the rows later windows still
+    need, the windows of a batch are strided views of it. A consumer that keeps every batch (as contpred does to
+    build its training set) still ends up with the whole log in memory
+    :param length: steps per trajectory (l of get_datasets)
+    :param stride: steps between the starts of trajectories, less than length for overlapping trajectories,
+                   defaults to length
+    :param start: rows skipped at the beginning of the log
+    :param chunksize: rows read from the CSV at a time
+    :return: generator of lists of (states, actions, deltas)
+    """
+    import pandas as pd
+    stride = stride or length
+    buffer = np.zeros((0, 7))
+    skip = start
+    for chunk in pd.read_csv(path, chunksize=chunksize, usecols=['roll', 'pitch', 'yaw', 'pwms'],
+                             error_bad_lines=False):
+        rows = log_rows(chunk)
+        drop = min(skip, len(rows))
+        skip -= drop
+        buffer = np.concatenate((buffer, rows[drop:]))
+        windows = strided_windows(buffer, length + 2, stride)
+        if len(windows):
+            yield window_trajectories(windows)
+            # with stride > length + 2 the next window can start past the rows read so far
+            skip += max(len(windows) * stride - len(buffer), 0)
+            buffer = buffer[len(windows) * stride:]
+
+
+def get_datasets(df, start=150, length=1000, stride=None):
+    """
+    :param df: the log columns, a DataFrame or the dict of load_log
+    :param start: rows skipped at the beginning of the log
+    :param length: steps per trajectory
+    :param stride: steps between the starts of trajectories, defaults to length
+    """
     # split df into trajectories
     states = ['omegax_0tx', 'omegay_0tx', 'omegaz_0tx', 'pitch_0tx', 'roll_0tx', 'yaw_0tx', 'linax_0tx', 'linay_0tx',
               'linyz_0tx']  #
     actions = ['m1pwm_0tu', 'm2pwm_0tu', 'm3pwm_0tu', 'm4pwm_0tu']
 
-    states = df[['roll', 'pitch', 'yaw']].to_numpy()
-    actions = df[['pwms']].to_numpy()
-    actions = np.stack([convert_pwm(a) for a in actions])
-
-    start = 150
-    l = 1000
-    n = np.shape(states)[0]
-    trajs = []
-    for i in range(int((n - start) / l)):
-        idx = i * l + start
-        s = states[idx:idx + l + 1, :]
-        a = actions[idx:idx + l + 1, :]
-        d = states[1 + idx:idx + l + 2, :] - states[idx:idx + l + 1, :]
-        trajs.append((s, a, d))
+    rows = log_rows(df)[start:]
+    trajs = window_trajectories(strided_windows(rows, length + 2, stride or length))
     # deltas = []
     data_train = trajs  # trajs[1::3]+trajs[2::3]
     data_test = []  # trajs[::3]
@@ -167,15 +299,21 @@ def contpred(cfg):
         log.info(f"Loading default data")
         # raise ValueError("Current Saved data old format")
         # Todo re-save data
-        import pandas as pd
-        raw_data = pd.read_csv(hydra.utils.get_original_cwd() + '/trajectories/crazyflie/' + 'cf2.csv',
-                               error_bad_lines=False, delimiter=',')  # 'cf.csv')
+        f = hydra.utils.get_original_cwd() + '/trajectories/crazyflie/' + 'cf2.csv'  # 'cf.csv')
+        hw = cfg.hardware
+        if hw.stream:
+            # only the parsing is streamed, training and evaluation use every window of the log at once
+            data_train = [traj for batch in stream_windows(f, hw.length, hw.stride, hw.start, hw.chunksize)
+                          for traj in batch]
+            data_test = []
+        else:
+            raw_data = load_log(f)
 
-    # raw_data = raw_data[::2]
-    # from plot import plot_cf
-    # plot_cf(raw_data[['pitch','pitch','pitch','pitch','roll','yaw']].to_numpy(), [])
+            # raw_data = raw_data[::2]
+            # from plot import plot_cf
+            # plot_cf(raw_data[['pitch','pitch','pitch','pitch','roll','yaw']].to_numpy(), [])
 
-    data_train, data_test = get_datasets(raw_data)
+            data_train, data_test = get_datasets(raw_data, hw.start, hw.length, hw.stride)
     if cfg.mode == 'train':
         it = range(cfg.copies) if cfg.copies else [0]
         prob = cfg.model.prob
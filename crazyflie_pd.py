@@ -32,6 +32,7 @@ log = logging.getLogger(__name__)
 from policy import PID
 from plot import plot_cf, plot_loss, setup_plotting
 from dynamics_model import DynamicsModel
+from trajectory_store import TrajectoryList, TrajectoryWriter
 from reacher_pd import run_controller, create_dataset_step, create_dataset_traj
 
 
@@ -164,6 +165,37 @@ class PidPolicy:
     #             self.pids[i + 3].update(EulerOut[i])
 
 
+class BatchPidPolicy(PidPolicy):
+    """
+    PidPolicy for M drones at once, row m uses the PD gains P[m], D[m] on pitch and roll. Same PWM mixing as
+    PidPolicy.get_action, computed on (M, ...) arrays.
+    """
+
+    def __init__(self, P, D, cfg):
+        super(BatchPidPolicy, self).__init__([], cfg)
+        if self.mode not in ('BASIC', 'INTEG'):
+            raise NotImplementedError("Other PID Modes not updated")
+        self.P = np.atleast_2d(P)
+        self.D = np.atleast_2d(D)
+        self.prev_error = np.zeros(np.shape(self.P))
+        self.mix = np.array([list(self.equil), list(self.p_m), list(self.r_m)], dtype=float)
+
+    def get_action(self, state, metric=None):
+        """
+        :param state: M x 3 euler angles
+        :return: M x 4 PWMs
+        """
+        error = -state[:, list(self.pry)[:2]]
+        actions = self.P * error + self.D * (error - self.prev_error)
+        self.prev_error = error
+        output = self.mix[0] + actions[:, :1] * self.mix[1] + actions[:, 1:] * self.mix[2]
+        self.last_action = np.clip(output, self.min_pwm, self.max_pwm)
+        return self.last_action
+
+    def reset(self):
+        self.prev_error = np.zeros(np.shape(self.P))
+
+
 def run_controller(env, horizon, policy, video=False):
     logs = DotMap()
     logs.states = []
@@ -204,16 +236,19 @@ def run_controller(env, horizon, policy, video=False):
     return logs
 
 
-def collect_data(cfg, plot=True):  # Creates horizon^2/2 points
+def collect_data(cfg, plot=True, writer=None):  # Creates horizon^2/2 points
     """
     Collect data for environment model
     :param nTrials:
     :param horizon:
+    :param writer: a trajectory_store.TrajectoryWriter every finished trajectory is written to as it
+                   finishes, so an interrupted run can resume: trials already in it are skipped. The returned
+                   trajectories are still read back into memory
     :return: an array of DotMaps, where each DotMap contains info about a trajectory
     """
 
     env_model = cfg.env.name
-    env = gym.make(env_model)
+    env = gym.make(env_model, integrator=cfg.env.integrator, substeps=cfg.env.substeps)
     # if (cfg.video):
     # env = Monitor(env, hydra.utils.get_original_cwd() + '/trajectories/reacher/video',
     # video_callable = lambda episode_id: episode_id==1,force=True)
@@ -221,11 +256,13 @@ def collect_data(cfg, plot=True):  # Creates horizon^2/2 points
 
     # Logs is an array of dotmaps, each dotmap contains 2d np arrays with data
     # about <horizon> steps with actions, rewards and states
-    logs = []
+    logs = writer if writer is not None else TrajectoryList()
     if (cfg.PID_test):
         target = np.random.rand(5) * 2 - 1
     s = np.random.randint(0, 100)
     for i in range(cfg.num_trials):
+        if i in logs.trials:
+            continue
         log.info('Trial %d' % i)
         env.seed(s + i)
 
@@ -276,11 +313,85 @@ def collect_data(cfg, plot=True):  # Creates horizon^2/2 points
         dotmap.P = P
         dotmap.I = I
         dotmap.D = D
-        logs.append(dotmap)
+        logs.append(i, dotmap)
+
+    return logs.read()
+
+
+def run_controller_batch(env, horizon, policy):
+    """
+    run_controller for a BatchCrazyFlieEnv and a BatchPidPolicy, all rows are stepped together until every
+    row is done or horizon is reached
 
+    :return: a DotMap with M x horizon states, actions and rewards, and lengths, the number of steps of each
+             row before it terminated (like run_controller, the terminating step is not counted)
+    """
+    observation = env.reset()
+    policy.reset()
+    M = env.num_envs
+    logs = DotMap()
+    logs.states = np.zeros((M, horizon, np.shape(observation)[1]))
+    logs.actions = np.zeros((M, horizon, env.u_dim))
+    logs.rewards = np.zeros((M, horizon))
+    logs.lengths = np.full(M, horizon)
+    for i in range(horizon):
+        action = policy.get_action(observation[:, 3:6])
+        observation, reward, done, info = env.step(action)
+        logs.lengths[done & (logs.lengths == horizon)] = i
+        if np.all(done):
+            break
+        logs.actions[:, i] = action
+        logs.rewards[:, i] = reward
+        logs.states[:, i] = observation
     return logs
 
 
+def collect_data_batch(cfg, plot=True, writer=None):
+    """
+    collect_data with all trials simulated together in a BatchCrazyFlieEnv. Trials that terminate early or do
+    not end within 5 degrees of level are re-run with new seeds and PD gains, again as one batch, until every
+    trial is accepted.
+    :param writer: see collect_data
+    :return: an array of DotMaps, where each DotMap contains info about a trajectory
+    """
+    from envs.crazyflie import BatchCrazyFlieEnv
+
+    log.info('Initializing batch env: %s x %d' % (cfg.env.name, cfg.num_trials))
+    horizon = cfg.trial_timesteps
+    logs = writer if writer is not None else TrajectoryList()
+    pending = np.array([i for i in range(cfg.num_trials) if i not in logs.trials], dtype=int)
+    s = np.random.randint(0, 100)
+    seeds = list(s + pending)
+    s += cfg.num_trials
+    while len(pending):
+        P = 100 + np.random.rand(len(pending), 2) * 10000
+        D = 10 + np.random.rand(len(pending), 2) * 50000
+        env = BatchCrazyFlieEnv(len(pending), integrator=cfg.env.integrator, substeps=cfg.env.substeps)
+        env.seed(seeds)
+        batch = run_controller_batch(env, horizon, BatchPidPolicy(P, D, cfg.pid))
+
+        final = np.abs(np.rad2deg(batch.states[:, -1, 3:5]))
+        accepted = (batch.lengths == horizon) & np.all(final < 5, axis=1)
+        for m in np.where(accepted)[0]:
+            dotmap = DotMap()
+            dotmap.states = batch.states[m]
+            dotmap.actions = batch.actions[m]
+            dotmap.rewards = batch.rewards[m]
+            dotmap.target = np.array([0, 0])
+            dotmap.P = P[m]
+            dotmap.I = np.zeros(2)
+            dotmap.D = D[m]
+            logs.append(pending[m], dotmap)
+            if plot: plot_cf(dotmap.states, dotmap.actions)
+        pending = pending[~accepted]
+        if len(pending):
+            log.info(f"- Repeat simulation of {len(pending)} trials")
+        seeds = list(s + np.arange(len(pending)))
+        s += len(pending)
+
+    return logs.read()
+
+
 ###########################################
 #           Plotting / Output             #
 ###########################################
@@ -308,12 +419,18 @@ def contpred(cfg):
     if not train:
         log.info(f"Collecting new trials")
 
-        exper_data = collect_data(cfg, plot=cfg.plot)
-        test_data = collect_data(cfg, plot=cfg.plot)
+        collect = collect_data_batch if cfg.batch and not cfg.video else collect_data
+        f = hydra.utils.get_original_cwd() + '/trajectories/crazyflie/' + 'raw' + cfg.data_dir
+        writers = [TrajectoryWriter(f + split, resume=cfg.resume) for split in ('.exper', '.test')]
+        log.info(f"Streaming trajectories to {f}.exper and {f}.test")
+        exper_data = collect(cfg, plot=cfg.plot, writer=writers[0])
+        test_data = collect(cfg, plot=cfg.plot, writer=writers[1])
+        [w.close() for w in writers]
 
         log.info("Saving new default data")
-        torch.save((exper_data, test_data),
-                   hydra.utils.get_original_cwd() + '/trajectories/crazyflie/' + 'raw' + cfg.data_dir)
+        torch.save((exper_data, test_data), f)
+        # the saved file replaces the stores of this collection
+        [w.remove() for w in writers]
         log.info(f"Saved trajectories to {'/trajectories/crazyflie/' + 'raw' + cfg.data_dir}")
     # Load data
     else:
@@ -347,6 +464,12 @@ def contpred(cfg):
 
             model = DynamicsModel(cfg)
             train_logs, test_logs = model.train(dataset, cfg)
+            if traj and cfg.model.training.get('reward_head', False):
+                from reward_rank import create_dataset_reward
+                log.info("Training reward head")
+                model.train_reward(create_dataset_reward(exper_data, cfg.env.label, model,
+                                                         threshold=cfg.model.training.filter_rate,
+                                                         t_range=cfg.model.training.t_range), cfg)
 
             setup_plotting({cfg.model.str: model})
             plot_loss(train_logs, test_logs, cfg, save_loc=cfg.env.name + '-' + cfg.model.str, show=False)
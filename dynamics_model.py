@@ -11,9 +11,55 @@ from collections import OrderedDict
 import hydra
 import math
 import GPy
+import multiprocessing as mp
+from timeit import default_timer as timer
 from omegaconf import OmegaConf
 
 
+def _build_gp(X, y, settings):
+    """
+    Builds the GPy model of one GP output, settings holds the kernel, ARD, sparse, num_inducing and fixNoise
+    """
+    if settings['kernel'] == 'Matern52':
+        kernel = GPy.kern.Matern52(input_dim=np.shape(X)[1], ARD=settings['ARD'])
+    elif settings['kernel'] == 'Linear':
+        kernel = GPy.kern.Linear(input_dim=np.shape(X)[1], ARD=settings['ARD'])
+    y = np.reshape(y, (len(y), -1))
+    if settings['sparse']:
+        model = GPy.models.SparseGPRegression(X, y, kernel=kernel, num_inducing=min(settings['num_inducing'], len(X)))
+    else:
+        model = GPy.models.GPRegression(X, y, kernel=kernel)
+    if settings['fixNoise'] is not None:
+        model.likelihood.variance.fix(settings['fixNoise'])
+    return model
+
+
+def _init_gp_worker(X, Y):
+    # the training data is sent once per worker instead of once per job
+    global _gp_data
+    _gp_data = (X, Y)
+
+
+def _fit_gp_restart(job):
+    """
+    Fits one (output, restart) job of GP.optimize, restart 0 starts from the default hyperparameters and
+    the others from random ones (as GPy's optimize_restarts). Output None fits all outputs with a shared kernel
+    :return: output, restart, log likelihood, optimized parameters, time taken
+    """
+    output, restart, seed, settings = job
+    start = timer()
+    np.random.seed(seed)
+    model = _build_gp(_gp_data[0], _gp_data[1] if output is None else _gp_data[1][:, output], settings)
+    if restart > 0:
+        model.randomize()
+    try:
+        model.optimize()
+        log_likelihood = np.asarray(model.log_likelihood()).item()
+    except np.linalg.LinAlgError:
+        log_likelihood = -np.inf
+    return output, restart, log_likelihood, model.param_array.copy(), timer() - start
+
+
 class GP(object):
     def __init__(self, n_in, n_out, cfg, loss_fn, env="Reacher", tf=nn.ReLU()):
         self.name = 'GP'  # Default value
@@ -25,6 +71,18 @@ class GP(object):
         self.kernel = 'Matern52'
         self.ARD = True
         self.fixNoise = None
+        # sparse inducing point GPs (SparseGPRegression) train on the full dataset, O(n m^2)
+        self.sparse = cfg.model.training.get('sparse', False)
+        self.num_inducing = cfg.model.training.get('num_inducing', 100)
+        # hyperparameter restarts per output, fanned out over processes (0 uses every core)
+        self.restarts = cfg.model.training.get('restarts', 10)
+        self.processes = cfg.model.training.get('processes', 0)
+        # one kernel shared by all outputs, so one factorization serves every output
+        self.shared = cfg.model.training.get('shared_kernel', False)
+        self._cache = None
+        # update() re-optimizes the hyperparameters every reopt_every calls (0 never)
+        self.reopt_every = cfg.model.training.get('reopt_every', 0)
+        self._num_updates = 0
 
         self.normalizeOutput = False
         self.t_output = None  # Store the output transformation
@@ -44,25 +102,50 @@ class GP(object):
         # self.n_outputs = train_set.get_dim_output()
         # logging.info('Dataset %d -> %d with %d data' % (self.n_inputs, self.n_outputs, train_set.get_n_data()))
 
-        if 0 < cfg.model.optimizer.max_size < len(dataset[0]):
+        d = dataset
+        if not self.sparse and 0 < cfg.model.optimizer.max_size < len(dataset[0]):
+            # exact GPs are O(n^3), so subsample
             use = np.random.randint(0, len(dataset[0]), cfg.model.optimizer.max_size)
             d = []
             d.append(dataset[0][use])
             d.append(dataset[1][use])
 
-        for i in range(self.n_outputs):
-            # logging.info('Training covariate %d (of %d)' % (i+1, self.n_outputs))
-            print('Training covariate %d (of %d)' % (i + 1, self.n_outputs))
-            if self.kernel == 'Matern52':
-                self._kernel.append(GPy.kern.Matern52(input_dim=self.n_inputs, ARD=self.ARD))
-            if self.kernel == 'Linear':
-                self._kernel.append(GPy.kern.Linear(input_dim=self.n_inputs, ARD=self.ARD))
-
-            # TODO check this line
-            self._model.append(GPy.models.GPRegression(d[0], d[1][:, 1].reshape(-1, 1), kernel=self._kernel[i]))
-            if self.fixNoise is not None:
-                self._model[i].likelihood.variance.fix(self.fixNoise)
-            self._model[i].optimize_restarts(num_restarts=10, verbose=False)  # , parallel=True, num_processes=5
+        X, Y = np.asarray(d[0], dtype=float), np.asarray(d[1], dtype=float)
+        settings = {'kernel': self.kernel, 'ARD': self.ARD, 'sparse': self.sparse,
+                    'num_inducing': self.num_inducing, 'fixNoise': self.fixNoise}
+        outputs = [None] if self.shared else range(self.n_outputs)
+        jobs = [(i, r, np.random.randint(2 ** 31), settings) for i in outputs for r in range(self.restarts)]
+        processes = min(self.processes or mp.cpu_count(), len(jobs))
+        print('Training %d covariates%s x %d restarts on %d processes' % (
+            self.n_outputs, ' (shared kernel)' if self.shared else '', self.restarts, processes))
+
+        start = timer()
+        if processes > 1:
+            with mp.Pool(processes, initializer=_init_gp_worker, initargs=(X, Y)) as pool:
+                results = list(pool.imap_unordered(_fit_gp_restart, jobs))
+        else:
+            _init_gp_worker(X, Y)
+            results = [_fit_gp_restart(job) for job in jobs]
+
+        # keep the best restart of each output
+        best = {}
+        for output, restart, log_likelihood, params, t in sorted(results, key=lambda r: r[:2]):
+            name = 'All covariates' if output is None else 'Covariate %d' % (output + 1)
+            print('  %s restart %d: log likelihood %.3f in %.2fs' % (name, restart, log_likelihood, t))
+            if output not in best or log_likelihood > best[output][0]:
+                best[output] = (log_likelihood, params)
+        print('Training completed in %.2fs' % (timer() - start))
+
+        self._kernel, self._model = [], []
+        for i in outputs:
+            model = _build_gp(X, Y if i is None else Y[:, i], settings)
+            model[:] = best[i][1]
+            self._kernel.append(model.kern)
+            self._model.append(model)
+
+        self._cache = None
+        if not self.sparse:
+            self._build_cache(X, Y)
 
         return 0, 0
         #
@@ -70,22 +153,244 @@ class GP(object):
         # logging.info('Training completed in %f[s]' % (end - self._startTime))
 
     def forward(self, x):
-        n_data = np.shape(x)[0]
-        mean = np.zeros((n_data, self.n_outputs))
-        var = np.zeros((n_data, self.n_outputs))
-        for i in range(self.n_outputs):
-            t_mean, t_var = self._model[i].predict(np.array(x))
-            mean[:, i] = t_mean.T
-            var[:, i] = t_var.T
+        x = np.array(x, dtype=float)
+        if getattr(self, '_cache', None) is not None:
+            mean, var = self._predict_cached(x)
+        elif getattr(self, 'shared', False):
+            mean, var = self._model[0].predict(x)
+            var = np.tile(var, (1, self.n_outputs))
+        else:
+            n_data = np.shape(x)[0]
+            mean = np.zeros((n_data, self.n_outputs))
+            var = np.zeros((n_data, self.n_outputs))
+            for i in range(self.n_outputs):
+                t_mean, t_var = self._model[i].predict(x)
+                mean[:, i] = t_mean.T
+                var[:, i] = t_var.T
         if np.any(var < 0):
             # logging.warning('Variance was negative! Now it is 0, but you should be careful!')
             var[var < 0] = 0  # Make sure that variance is always positive
-        return np.concatenate((mean, var))
+        return np.hstack((mean, var))
+
+    def _columns(self):
+        # the output columns predicted by each GPy model
+        if getattr(self, 'shared', False):
+            return [slice(None)]
+        return [[i] for i in range(self.n_outputs)]
+
+    def _build_cache(self, X, Y):
+        # the Cholesky factor of K + noise I and (K + noise I)^-1 Y of every GPy model, computed once by GPy
+        self._cache = {'X': X, 'Y': Y,
+                       'L': [m.posterior.woodbury_chol for m in self._model],
+                       'alpha': [m.posterior.woodbury_vector for m in self._model],
+                       'noise': [np.asarray(m.likelihood.variance).item() for m in self._model]}
+
+    def _predict_cached(self, x):
+        """
+        Batched mean and variance of all outputs of an exact GP from the cached factorizations,
+        O(n) per point for the mean and O(n^2) for the variance (shared by all outputs of a shared kernel)
+        """
+        from scipy.linalg import solve_triangular
+        cache = self._cache
+        mean = np.zeros((len(x), self.n_outputs))
+        var = np.zeros((len(x), self.n_outputs))
+        for i, (model, cols) in enumerate(zip(self._model, self._columns())):
+            Ks = model.kern.K(x, cache['X'])
+            mean[:, cols] = Ks @ cache['alpha'][i]
+            v = solve_triangular(cache['L'][i], Ks.T, lower=True)
+            var[:, cols] = (model.kern.Kdiag(x) - np.sum(v ** 2, axis=0) + cache['noise'][i]).reshape(-1, 1)
+        return mean, var
+
+    def update(self, new_x, new_y):
+        """
+        Adds k points to an exact GP without refitting. The cached Cholesky factor L of the n training points
+        is extended with a block update,
+            [L 0; L12^T L22] with L12 = L^-1 K(X, new_x) and L22 = chol(K(new_x) + noise I - L12^T L12),
+        and (K + noise I)^-1 Y is refreshed with two triangular solves, O(n^2 k + k^3) instead of O((n + k)^3).
+        The hyperparameters are re-optimized (warm started, on all points) every reopt_every updates.
+        """
+        from scipy.linalg import solve_triangular, cho_solve
+        if getattr(self, '_cache', None) is None:
+            raise ValueError("GP.update needs an exact GP (sparse: false) trained with optimize")
+        new_x = np.atleast_2d(np.asarray(new_x, dtype=float))
+        new_y = np.reshape(np.asarray(new_y, dtype=float), (len(new_x), self.n_outputs))
+        cache = self._cache
+        X, Y = np.vstack((cache['X'], new_x)), np.vstack((cache['Y'], new_y))
+
+        self._num_updates = getattr(self, '_num_updates', 0) + 1
+        if getattr(self, 'reopt_every', 0) and self._num_updates % self.reopt_every == 0:
+            start = timer()
+            for model, cols in zip(self._model, self._columns()):
+                model.set_XY(X, Y[:, cols])
+                model.optimize()
+            self._build_cache(X, Y)
+            print('Re-optimized GP hyperparameters on %d points in %.2fs' % (len(X), timer() - start))
+            return
+
+        for i, (model, cols) in enumerate(zip(self._model, self._columns())):
+            L = cache['L'][i]
+            L12 = solve_triangular(L, model.kern.K(cache['X'], new_x), lower=True)
+            K22 = model.kern.K(new_x) + cache['noise'][i] * np.eye(len(new_x))
+            L22 = np.linalg.cholesky(K22 - L12.T @ L12)
+            L = np.block([[L, np.zeros((len(L), len(new_x)))], [L12.T, L22]])
+            cache['L'][i] = L
+            cache['alpha'][i] = cho_solve((L, True), Y[:, cols])
+        cache['X'], cache['Y'] = X, Y
+
+    def testPreprocess(self, input, cfg):
+        # the GP is trained on unnormalized inputs
+        if torch.is_tensor(input):
+            input = input.numpy()
+        return np.asarray(input)
+
+    def testPostprocess(self, output):
+        # the mean of the forward pass, as predicted by the nets
+        return torch.from_numpy(np.asarray(output)[:, :self.n_outputs])
 
     def get_hyperparameters(self):
         return self._model._param_array_
 
 
+def _matern52(x1, x2, lengthscale):
+    # ARD Matern 5/2 kernel with unit variance between the rows of two tensors
+    r = torch.cdist(x1 / lengthscale, x2 / lengthscale)
+    return (1 + math.sqrt(5) * r + 5 / 3 * r ** 2) * torch.exp(-math.sqrt(5) * r)
+
+
+def _eigh(A):
+    # torch.linalg only exists from torch 1.8, the pinned 1.5 has symeig
+    if hasattr(torch, 'linalg') and hasattr(torch.linalg, 'eigh'):
+        return torch.linalg.eigh(A)
+    return torch.symeig(A, eigenvectors=True)
+
+
+class KroneckerGP(GP):
+    """
+    GP trajectory model on a regular time grid. The inputs (state_0, t, params) are split into the condition
+    (initial state and control params) and the time index, with a product kernel k_c(c, c') k_t(t, t') shared by
+    all outputs. On a complete grid of N conditions x T time indices the kernel matrix is K_c (x) K_t, so training
+    and prediction only need the eigendecompositions of K_c and K_t: O(N^3 + T^3) instead of O((N T)^3).
+    """
+
+    def __init__(self, n_in, n_out, cfg, loss_fn, env="Reacher", tf=nn.ReLU()):
+        GP.__init__(self, n_in, n_out, cfg, loss_fn, env=env, tf=tf)
+        self.name = 'KroneckerGP'
+        # the time index column follows the state in trajectory model inputs
+        self.index_col = len(cfg.model.training.state_indices)
+        self.max_conditions = cfg.model.training.get('num_traj', 0)
+        self.iterations = cfg.model.training.get('kron_iters', 200)
+        self.lr = cfg.model.training.get('kron_lr', .05)
+
+    def grid(self, X, Y):
+        """
+        Extracts a complete grid from a flat trajectory dataset: the conditions with a row for every time index
+        1..T, where T is chosen to keep the most rows of at most max_conditions conditions (trajectories can
+        end early)
+        :return: conditions (N x n_cond), time indices (T), outputs (N x T x D)
+        """
+        t = np.round(X[:, self.index_col]).astype(int)
+        cond = np.delete(X, self.index_col, axis=1)
+        conds, group = np.unique(cond, axis=0, return_inverse=True)
+        group = np.reshape(group, -1)
+        valid = t >= 1
+        rows = np.full((len(conds), t.max()), -1)
+        rows[group[valid], t[valid] - 1] = np.arange(len(X))[valid]
+
+        # length of the complete prefix 1..L of every condition, then the T maximizing N x T with N capped at
+        # max_conditions, so capping the conditions does not also cut the horizon
+        lengths = np.where(np.all(rows >= 0, axis=1), rows.shape[1], np.argmin(rows >= 0, axis=1))
+        candidates = np.unique(lengths[lengths > 0])
+        counts = np.array([np.sum(lengths >= c) for c in candidates])
+        if self.max_conditions > 0:
+            counts = np.minimum(counts, self.max_conditions)
+        T = candidates[np.argmax(candidates * counts)]
+        keep = np.where(lengths >= T)[0]
+        if 0 < self.max_conditions < len(keep):
+            keep = np.random.choice(keep, self.max_conditions, replace=False)
+        return conds[keep], np.arange(1, T + 1), Y[rows[keep, :T]]
+
+    def optimize(self, dataset, cfg):
+        X, Y = np.asarray(dataset[0], dtype=float), np.asarray(dataset[1], dtype=float)
+        # kept for update, which refits on the enlarged dataset
+        self._data = (X, Y)
+        C, times, Y = self.grid(X, Y)
+        N, T, D = Y.shape
+        print('Training Kronecker GP on %d conditions x %d time indices (%d of %d rows)' % (N, T, N * T, len(X)))
+
+        self.c_mean, self.c_std = C.mean(axis=0), C.std(axis=0) + 1e-8
+        self.t_scale = float(T)
+        self.y_mean, self.y_std = Y.mean(axis=(0, 1)), Y.std(axis=(0, 1)) + 1e-8
+        C = torch.from_numpy((C - self.c_mean) / self.c_std)
+        times = torch.from_numpy(times.reshape(-1, 1) / self.t_scale)
+        Y = torch.from_numpy((Y - self.y_mean) / self.y_std).permute(2, 0, 1)
+
+        log_lc = torch.zeros(C.shape[1], dtype=torch.double, requires_grad=True)
+        log_lt = torch.tensor([np.log(.1)], dtype=torch.double, requires_grad=True)
+        log_sf = torch.zeros(1, dtype=torch.double, requires_grad=True)
+        log_sn = torch.tensor([np.log(.01)], dtype=torch.double, requires_grad=True)
+        optimizer = torch.optim.Adam([log_lc, log_lt, log_sf, log_sn], lr=self.lr)
+
+        start = timer()
+        for i in range(self.iterations):
+            optimizer.zero_grad()
+            lam_c, Q_c = _eigh(_matern52(C, C, torch.exp(log_lc)))
+            lam_t, Q_t = _eigh(torch.exp(log_sf) * _matern52(times, times, torch.exp(log_lt)))
+            S = torch.clamp(lam_c[:, None] * lam_t[None, :], min=0) + torch.exp(log_sn) + 1e-6
+            Y_rot = Q_c.t() @ Y @ Q_t
+            # negative log marginal likelihood per data point, all outputs share the kernel
+            nll = (0.5 * torch.sum(Y_rot ** 2 / S) + 0.5 * D * torch.sum(torch.log(S))) / (N * T * D)
+            nll.backward()
+            optimizer.step()
+            if (i + 1) % 50 == 0:
+                print('  Iter %d/%d - nll: %.4f' % (i + 1, self.iterations, nll.item()))
+        print('Training completed in %.2fs' % (timer() - start))
+
+        # cache the eigendecompositions and (K + noise I)^-1 Y for prediction
+        with torch.no_grad():
+            self.lengthscale_c, self.lengthscale_t = torch.exp(log_lc), torch.exp(log_lt)
+            self.signal, self.noise = torch.exp(log_sf), torch.exp(log_sn) + 1e-6
+            lam_c, Q_c = _eigh(_matern52(C, C, self.lengthscale_c))
+            lam_t, Q_t = _eigh(self.signal * _matern52(times, times, self.lengthscale_t))
+            S = torch.clamp(lam_c[:, None] * lam_t[None, :], min=0) + self.noise
+            self._cache = {'C': C, 'times': times, 'Q_c': Q_c, 'Q_t': Q_t, 'W': 1 / S,
+                           'alpha': Q_c @ ((Q_c.t() @ Y @ Q_t) / S) @ Q_t.t()}
+        return 0, 0
+
+    def forward(self, x):
+        """
+        Mean and variance (hstacked as in GP.forward) at arbitrary (state_0, t, params) rows, O(N^2 + T^2) each
+        """
+        x = np.asarray(x, dtype=float)
+        c = torch.from_numpy((np.delete(x, self.index_col, axis=1) - self.c_mean) / self.c_std)
+        t = torch.from_numpy(x[:, [self.index_col]] / self.t_scale)
+        cache = self._cache
+        with torch.no_grad():
+            A = _matern52(c, cache['C'], self.lengthscale_c)
+            B = self.signal * _matern52(t, cache['times'], self.lengthscale_t)
+            mean = torch.einsum('mn,dnt,mt->md', A, cache['alpha'], B)
+            a, b = A @ cache['Q_c'], B @ cache['Q_t']
+            var = self.signal - torch.sum(((a ** 2) @ cache['W']) * b ** 2, dim=1) + self.noise
+        mean = mean.numpy() * self.y_std + self.y_mean
+        var = np.clip(var.numpy(), 0, None).reshape(-1, 1) * self.y_std ** 2
+        return np.hstack((mean, var))
+
+    def update(self, new_x, new_y):
+        """
+        Adds points by refitting on the training data and the new rows. The grid is rebuilt, so new trajectories
+        only count once they cover the time indices 1..T of the grid (or give a larger grid together).
+        """
+        if getattr(self, '_data', None) is None:
+            raise ValueError("KroneckerGP.update needs a model trained with optimize")
+        X, Y = self._data
+        new_x = np.atleast_2d(np.asarray(new_x, dtype=float))
+        new_y = np.reshape(np.asarray(new_y, dtype=float), (len(new_x), self.n_outputs))
+        self.optimize((np.vstack((X, new_x)), np.vstack((Y, new_y))), None)
+
+    def get_hyperparameters(self):
+        return {'lengthscale_c': self.lengthscale_c.numpy(), 'lengthscale_t': self.lengthscale_t.numpy(),
+                'signal': self.signal.item(), 'noise': self.noise.item()}
+
+
 class Net(nn.Module):
     """
     General Neural Network
@@ -213,6 +518,58 @@ class Net(nn.Module):
     def testPostprocess(self, output):
         return torch.from_numpy(self.outputScaler.inverse_transform(output.detach().numpy()))
 
+    def fused_scalers(self, cfg):
+        """
+        Folds the fitted sklearn scalers into per-feature affine maps, such that
+        testPreprocess(x) = x * in_slope + in_offset and testPostprocess(y) = y * out_slope + out_offset
+        """
+        if getattr(self, '_fused', None) is None:
+            in_offset = self.testPreprocess(np.zeros((1, self.n_in)), cfg)
+            in_slope = self.testPreprocess(np.ones((1, self.n_in)), cfg) - in_offset
+            n = len(self.outputScaler.scale_)
+            out_offset = self.outputScaler.inverse_transform(np.zeros((1, n)))
+            out_slope = self.outputScaler.inverse_transform(np.ones((1, n))) - out_offset
+            self._fused = tuple(torch.tensor(a, dtype=torch.float) for a in
+                                (in_slope, in_offset, out_slope, out_offset))
+        return self._fused
+
+    def fused_forward(self, x, cfg):
+        """
+        Differentiable forward pass in unnormalized units, with the scalers fused into the network.
+        Returns the mean prediction and, for probabilistic nets, the variance (logvar clamped as in ProbLoss),
+        otherwise None
+        """
+        in_slope, in_offset, out_slope, out_offset = self.fused_scalers(cfg)
+        out = self.forward(x.float() * in_slope + in_offset)
+        n = out_slope.shape[1]
+        mean = out[:, :n] * out_slope + out_offset
+        if out.shape[1] == n:
+            return mean, None
+        logvar = torch.min(out[:, n:], self.loss_fn.max_logvar.detach())
+        logvar = torch.max(logvar, self.loss_fn.min_logvar.detach())
+        return mean, torch.exp(logvar) * out_slope ** 2
+
+    def linearize(self, x, cfg):
+        """
+        Batched linearization of the fused network around each row of x (unnormalized inputs).
+        The rows are replicated once per output so all N Jacobians cost one forward and one backward pass.
+        Returns the mean (N x n_out), the variance (N x n_out, None if deterministic) and the Jacobian
+        of the mean with respect to the input (N x n_out x n_in)
+        """
+        if type(x) == np.ndarray:
+            x = torch.from_numpy(np.float32(x))
+        N = x.shape[0]
+        n = self.fused_scalers(cfg)[2].shape[1]
+        rep = x.detach().float().repeat(n, 1).requires_grad_(True)
+        mean, var = self.fused_forward(rep, cfg)
+        mean = mean.view(n, N, n)
+        k = torch.arange(n)
+        jac, = torch.autograd.grad(mean[k, :, k].sum(), rep)
+        jac = jac.view(n, N, -1).transpose(0, 1)
+        if var is not None:
+            var = var.view(n, N, n)[0].detach()
+        return mean[0].detach(), var, jac
+
     def preprocess(self, dataset, cfg):
 
         # Select scaling, minmax vs standard (fits to a gaussian with unit variance and 0 mean)
@@ -222,6 +579,7 @@ class Net(nn.Module):
         # 26 -> one-step, 37 -> trajectory
         input = dataset[0]
         output = dataset[1]
+        self._fused = None
         if cfg.model.traj:
             # no control params (state + time index)
             if np.shape(dataset[0])[1] == len(self.state_indices) + 1:
@@ -420,12 +778,16 @@ class DynamicsModel(object):
         else:
             self.loss_fn = nn.MSELoss()
         if env == "Reacher":
-            if cfg.model.gp:
+            if cfg.model.gp and self.traj and cfg.model.training.get('kronecker', False):
+                self.nets = [KroneckerGP(self.n_in, self.n_out, cfg, self.loss_fn) for i in range(self.E)]
+            elif cfg.model.gp:
                 self.nets = [GP(self.n_in, self.n_out, cfg, self.loss_fn) for i in range(self.E)]
             else:
                 self.nets = [Net(self.n_in, self.n_out, cfg, self.loss_fn) for i in range(self.E)]
         elif env == "Lorenz" or env == "SS":
             self.nets = [Net(self.n_in, self.n_out, cfg, self.loss_fn, env="Lorenz") for i in range(self.E)]
+        # optional cumulative reward head for trajectory models, see train_reward
+        self.reward_net = None
 
     def predict_lstm(self, x, num_traj=1):
         # LSTM takes in a variable length object and predicts the next in the future.
@@ -447,7 +809,7 @@ class DynamicsModel(object):
         """
         Use the model to predict values with x as input
         TODO: Fix hardcoding in this method
-        TODO: particle sampling approach for probabilistic model
+        Note: for probabilistic models this propagates the ensemble mean, see predict_particles for sampling
         """
         if type(x) == np.ndarray:
             x = torch.from_numpy(np.float64(x))
@@ -466,6 +828,127 @@ class DynamicsModel(object):
             # This hardcode is the state size changing. X also includes the action / index
             return x[:, :len(self.state_indices)] + prediction
 
+    def input_slices(self):
+        """
+        Column ranges of the model input: states, then actions for one-step models
+        or the time index and control parameters for trajectory models
+        """
+        n_state = len(self.state_indices)
+        if self.traj:
+            return {'state': slice(0, n_state), 'index': slice(n_state, n_state + 1),
+                    'params': slice(n_state + 1, self.n_in)}
+        else:
+            return {'state': slice(0, n_state), 'action': slice(n_state, self.n_in)}
+
+    def traj_input(self, initials, params, horizon):
+        """
+        Trajectory model input predicting a full horizon for many control parameters in one call.
+        Row c * horizon + t - 1 is (initials[c], t, params[c]) for t = 1..horizon
+        :param initials: initial state (in state_indices), shared or one per row of params
+        :param params: C x n_params control parameters (and targets, if trained with them)
+        """
+        params = np.atleast_2d(params)
+        C = np.shape(params)[0]
+        initials = np.broadcast_to(np.atleast_2d(initials), (C, len(self.state_indices)))
+        index = np.tile(np.arange(1, horizon + 1), C).reshape(-1, 1)
+        return np.hstack((np.repeat(initials, horizon, axis=0), index, np.repeat(params, horizon, axis=0)))
+
+    def fused_predict(self, x):
+        """
+        Differentiable version of predict (ensemble mean, torch in and out) running through the fused-scaler
+        networks, so gradients can be taken with respect to x
+        """
+        if type(x) == np.ndarray:
+            x = torch.from_numpy(np.float32(x))
+        prediction = sum(n.fused_forward(x, self.cfg)[0] for n in self.nets) / len(self.nets)
+        if not self.delta:
+            return prediction
+        else:
+            return x[:, :len(self.state_indices)].float() + prediction
+
+    def jacobian(self, x, wrt='state'):
+        """
+        Batched Jacobians of the (ensemble mean) prediction at every row of x, computed with vectorized
+        autograd through the fused-scaler networks rather than finite differences.
+
+        :param x: N x n_in array or tensor of unnormalized inputs, as passed to predict
+        :param wrt: 'state', 'action' (one-step models), 'index', 'params' (trajectory models)
+                    or None for the full input
+        :return: N x D x n_wrt tensor, d prediction / d x[wrt]
+        """
+        n_state = len(self.state_indices)
+        jac = sum(n.linearize(x, self.cfg)[2] for n in self.nets) / len(self.nets)
+        if self.delta:
+            jac[:, :, :n_state] += torch.eye(n_state)
+        if wrt is None:
+            return jac
+        return jac[:, :, self.input_slices()[wrt]]
+
+    def sample_members(self, num_particles):
+        """
+        Randomly assigns each of num_particles particles to one of the ensemble members
+        """
+        return np.random.randint(0, len(self.nets), num_particles)
+
+    def predict_particles(self, x, members):
+        """
+        Trajectory sampling step for probabilistic models. Row i of x is passed through the ensemble member
+        members[i] and the prediction is sampled from that member's Gaussian (logvar clamped as in ProbLoss).
+        All particles assigned to a member are evaluated as one batch through the fused-scaler network, so an
+        (N*P, n_in) input costs at most one forward pass per ensemble member and never leaves torch.
+        Deterministic models return the mean prediction of the assigned member.
+        """
+        if type(x) == np.ndarray:
+            x = torch.from_numpy(np.float32(x))
+        x = x.float()
+        n_state = len(self.state_indices)
+        members = np.asarray(members)
+        prediction = torch.zeros((x.shape[0], n_state))
+        with torch.no_grad():
+            for e, n in enumerate(self.nets):
+                rows = torch.from_numpy(np.where(members == e)[0])
+                if len(rows) == 0:
+                    continue
+                mean, var = n.fused_forward(x[rows], self.cfg)
+                if var is not None:
+                    mean = mean + torch.randn_like(mean) * torch.sqrt(var)
+                prediction[rows] = mean
+        if not self.delta:
+            return prediction
+        else:
+            return x[:, :n_state] + prediction
+
+    def predict_moments(self, mean, cov, actions=None):
+        """
+        Moment matching step for one-step models. Propagates the Gaussian state belief N(mean, cov) by
+        linearizing each ensemble member around the mean, then adds the predicted aleatoric variance and
+        the spread of the member means.
+
+        :param mean: N x D tensor of state means
+        :param cov: N x D x D tensor of state covariances
+        :param actions: N x A tensor of actions, None for autonomous systems
+        :return: next state mean (N x D) and covariance (N x D x D)
+        """
+        n_state = len(self.state_indices)
+        inp = mean if actions is None else torch.cat((mean, actions), dim=1)
+        means, covs = [], []
+        for n in self.nets:
+            mu, var, jac = n.linearize(inp, self.cfg)
+            jac = jac[:, :, :n_state]
+            if self.delta:
+                mu = mean + mu
+                jac = jac + torch.eye(n_state)
+            c = torch.matmul(torch.matmul(jac, cov), jac.transpose(1, 2))
+            if var is not None:
+                c = c + torch.diag_embed(var)
+            means.append(mu)
+            covs.append(c)
+        means = torch.stack(means)
+        next_mean = means.mean(dim=0)
+        spread = means - next_mean
+        next_cov = torch.stack(covs).mean(dim=0) + torch.einsum('enj,enk->njk', spread, spread) / len(self.nets)
+        return next_mean, next_cov
+
     def train(self, dataset, cfg):
         acctest_l = []
         acctrain_l = []
@@ -512,6 +995,37 @@ class DynamicsModel(object):
         return acctrain_l, acctest_l
 
 
+    def train_reward(self, dataset, cfg):
+        """
+        Trains a reward head for a trajectory model: a separate net from the same (state_i, j - i, params)
+        inputs to the reward accumulated over states i+1..j, so the return of a horizon is one forward pass
+        :param dataset: (inputs laid out as for train, N x 1 cumulative rewards), see reward_rank.create_dataset_reward
+        """
+        if not self.traj:
+            raise ValueError("Reward head needs a trajectory model")
+        # same input reform as in train
+        if not self.train_target and not self.control_params:
+            data_in = np.hstack((dataset[0][:, self.state_indices], dataset[0][:, [self.cfg.env.state_size]]))
+        else:
+            data_in = np.hstack((dataset[0][:, self.state_indices], dataset[0][:, self.cfg.env.state_size:]))
+
+        self.reward_net = Net(self.n_in, 1, cfg, nn.MSELoss())
+        train_e, test_e = self.reward_net.optimize((data_in, np.reshape(dataset[1], (-1, 1))), cfg)
+        return train_e, test_e
+
+    def predict_reward(self, x):
+        """
+        Cumulative reward predicted by the reward head for trajectory model inputs x (as passed to predict),
+        differentiable with respect to x
+        :return: N tensor, the reward summed over the x[:, index] states following the initial state
+        """
+        if self.reward_net is None:
+            raise ValueError("Model has no reward head, see train_reward")
+        if type(x) == np.ndarray:
+            x = torch.from_numpy(np.float32(x))
+        return self.reward_net.fused_forward(x, self.cfg)[0][:, 0]
+
+
 class ProbLoss(nn.Module):
     """
     Class for probabilistic loss function
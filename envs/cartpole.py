@@ -210,3 +210,68 @@ class CartPoleContEnv(gym.Env):
         if self.viewer:
             self.viewer.close()
             self.viewer = None
+
+
+class BatchCartPoleContEnv(CartPoleContEnv):
+    """
+    M independent copies of CartPoleContEnv stepped together, states are (M, 4) arrays. Each row has its own
+    seed, so row m seeded with s resets to the same initial state as CartPoleContEnv seeded with s, and its own
+    done flag. Rows that are done are frozen (state kept, reward 0) until the next reset.
+    """
+
+    def __init__(self, num_envs=1):
+        self.num_envs = num_envs
+        super(BatchCartPoleContEnv, self).__init__()
+        self.done = np.zeros(num_envs, dtype=bool)
+
+    def seed(self, seed=None):
+        """
+        :param seed: a list of M seeds, or a single seed s giving rows the seeds s, s+1, ..., s+M-1
+        """
+        if seed is None or np.isscalar(seed):
+            seed = [None if seed is None else seed + m for m in range(self.num_envs)]
+        if len(seed) != self.num_envs:
+            raise ValueError("Need %d seeds, got %d" % (self.num_envs, len(seed)))
+        self.np_randoms, seeds = zip(*[seeding.np_random(s) for s in seed])
+        return list(seeds)
+
+    def step(self, action):
+        action = np.reshape(action, (self.num_envs,))
+        if np.any(np.abs(action) > 1.0):
+            raise ValueError("Actions outside of [-1, 1]: %r" % action[np.abs(action) > 1.0])
+        x, x_dot, theta, theta_dot = self.state.T
+        force = self.force_mag * action
+        costheta = np.cos(theta)
+        sintheta = np.sin(theta)
+        temp = (force + self.polemass_length * theta_dot * theta_dot * sintheta) / self.total_mass
+        thetaacc = (self.gravity * sintheta - costheta * temp) / \
+                   (self.length * (4.0 / 3.0 - self.masspole * costheta * costheta / self.total_mass))
+        xacc = temp - self.polemass_length * thetaacc * costheta / self.total_mass
+        if self.kinematics_integrator == 'euler':
+            x = x + self.tau * x_dot
+            x_dot = x_dot + self.tau * xacc
+            theta = theta + self.tau * theta_dot
+            theta_dot = theta_dot + self.tau * thetaacc
+        else:  # semi-implicit euler
+            x_dot = x_dot + self.tau * xacc
+            x = x + self.tau * x_dot
+            theta_dot = theta_dot + self.tau * thetaacc
+            theta = theta + self.tau * theta_dot
+
+        active = ~self.done
+        self.state[active] = np.stack((x, x_dot, theta, theta_dot), axis=1)[active]
+        done = (np.abs(x) > self.x_threshold) | (np.abs(theta) > self.theta_threshold_radians)
+        # the termination step is still rewarded, as in CartPoleContEnv
+        reward = active.astype(float)
+        self.done = self.done | (done & active)
+        return self.state.copy(), reward, self.done.copy(), {}
+
+    def reset(self):
+        self.state = np.stack([r.uniform(low=-0.05, high=0.05, size=(4,)) for r in self.np_randoms])
+        self.state[:, 0] = self.state[:, 0] * 20
+        self.state[:, 2] = self.state[:, 2] * 20
+        self.done = np.zeros(self.num_envs, dtype=bool)
+        return self.state.copy()
+
+    def render(self, mode='human'):
+        raise NotImplementedError("Rendering is not supported for the batch environment")
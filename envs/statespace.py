@@ -3,6 +3,7 @@ import gym
 from gym import spaces, logger
 from gym.utils import seeding
 import numpy as np
+from dotmap import DotMap
 from control import StateSpace
 
 
@@ -76,4 +77,51 @@ class StateSpaceEnv(gym.Env):
     def reset(self):
         self.state = self.np_random.uniform(low=-1, high=1, size=(self.dx,1))
         # return np.array(self.state
-        return self.get_obs()
\ No newline at end of file
+        return self.get_obs()
+
+    def initial_states(self, seeds, resets=1):
+        """
+        M initial states at once, row m is the state of the last of resets calls of reset() after seed(seeds[m])
+        :return: M x dx states
+        """
+        states = []
+        for s in seeds:
+            np_random = seeding.np_random(s)[0]
+            for r in range(resets):
+                state = np_random.uniform(low=-1, high=1, size=(self.dx,))
+            states.append(state)
+        return np.stack(states)
+
+    def rollout(self, x0, actions):
+        """
+        Simulates M copies of the system for T steps, x_{t+1} = A x_t + B u_t for all rows in one matrix product
+        per step instead of one env.step per row and step
+
+        :param x0: M x dx initial states
+        :param actions: M x T x du actions
+        :return: an array of M DotMaps with the T x dy observations, T x du actions and T rewards after each step,
+                 as logged by run_controller
+        """
+        if not self.setup_ran:
+            raise ValueError("System not yet passed")
+        A = np.asarray(self.sys.A)
+        B = np.asarray(self.sys.B)
+        C = np.asarray(self.sys.C)
+        M, T = np.shape(actions)[:2]
+        x = np.zeros((M, T, self.dx))
+        state = np.asarray(x0, dtype=float)
+        forced = actions @ B.T
+        for t in range(T):
+            state = state @ A.T + forced[:, t]
+            x[:, t] = state
+        obs = x @ C.T
+        rewards = -(np.mean(x, axis=2) ** 2 + np.mean(actions, axis=2) ** 2)
+
+        logs = []
+        for m in range(M):
+            dotmap = DotMap()
+            dotmap.states = obs[m]
+            dotmap.actions = actions[m]
+            dotmap.rewards = rewards[m]
+            logs.append(dotmap)
+        return logs
@@ -30,7 +30,110 @@ def forward_var(model, x):
     return torch.exp(variance)
 
 
-def test_models(test_data, models, verbose=False, env=None, compute_action=False, ret_var=False, t_range=np.inf):
+def particle_rollout(model, initials, T, actions=None, act_fn=None, num_particles=20, propagation='ts1',
+                     quantiles=(.05, .5, .95)):
+    """
+    Propagates uncertainty through a one-step probabilistic (ensemble) model with trajectory sampling.
+    Each of the N initial states is copied into num_particles particles and all N*P particles are
+    stepped together, so each timestep is one batched call to model.predict_particles.
+
+    Parameters:
+        model: a one-step DynamicsModel
+        initials: N x D array of initial states (in model.state_indices)
+        T: number of states in the rollout, including the initial state
+        actions: N x (T-1) x A array of actions for open loop rollouts, None for autonomous systems
+        act_fn: optional function mapping the (N*P) x D particle states to (N*P) x A actions (closed loop),
+                overrides actions
+        num_particles: P, the number of particles per trajectory
+        propagation: 'ts1' reassigns particles to random ensemble members every step,
+                     'tsinf' keeps the assignment fixed for the whole rollout
+        quantiles: the quantiles of the particle distribution to return
+
+    Returns:
+        mean: N x T x D mean of the particles
+        var: N x T x D variance of the particles
+        quants: len(quantiles) x N x T x D quantiles of the particles
+    """
+    if propagation not in ('ts1', 'tsinf'):
+        raise ValueError("Invalid propagation: " + str(propagation))
+    N, D = np.shape(initials)
+    P = num_particles
+
+    # particles of trajectory n are rows n*P to (n+1)*P
+    particles = np.zeros((N * P, T, D))
+    particles[:, 0, :] = np.repeat(initials, P, axis=0)
+    members = model.sample_members(N * P)
+    for i in range(1, T):
+        if propagation == 'ts1':
+            members = model.sample_members(N * P)
+        current = particles[:, i - 1, :]
+        if act_fn is not None:
+            inp = np.hstack((current, act_fn(current)))
+        elif actions is not None:
+            inp = np.hstack((current, np.repeat(actions[:, i - 1, :], P, axis=0)))
+        else:
+            inp = current
+        particles[:, i, :] = model.predict_particles(inp, members).detach().numpy()
+
+    particles = particles.reshape((N, P, T, D))
+    mean = np.mean(particles, axis=1)
+    var = np.var(particles, axis=1)
+    quants = np.quantile(particles, quantiles, axis=1)
+    return mean, var, quants
+
+
+def moment_rollout(model, initials, T, actions=None, act_fn=None):
+    """
+    Propagates uncertainty through a one-step probabilistic (ensemble) model by moment matching.
+    The state belief is kept Gaussian and pushed through the locally linearized model at each step
+    (see DynamicsModel.predict_moments), costing a few batched forward passes per step.
+
+    Parameters:
+        model: a one-step DynamicsModel
+        initials: N x D array of initial states (in model.state_indices), with zero initial covariance
+        T: number of states in the rollout, including the initial state
+        actions: N x (T-1) x A array of actions for open loop rollouts, None for autonomous systems
+        act_fn: optional function mapping the N x D state means to N x A actions (closed loop), overrides actions
+
+    Returns:
+        mean: N x T x D predicted state means
+        var: N x T x D predicted state variances (diagonal of the covariance)
+    """
+    N, D = np.shape(initials)
+    mean = torch.from_numpy(np.float32(initials))
+    cov = torch.zeros((N, D, D))
+    means, variances = [mean.numpy()], [np.zeros((N, D))]
+    for i in range(1, T):
+        if act_fn is not None:
+            acts = torch.from_numpy(np.float32(act_fn(mean.numpy())))
+        elif actions is not None:
+            acts = torch.from_numpy(np.float32(actions[:, i - 1, :]))
+        else:
+            acts = None
+        mean, cov = model.predict_moments(mean, cov, acts)
+        means.append(mean.numpy())
+        variances.append(np.diagonal(cov.numpy(), axis1=1, axis2=2))
+    return np.stack(means, axis=1), np.stack(variances, axis=1)
+
+
+def batch_policy(policies, copies):
+    """
+    One batch policy (policy.BatchPID or policy.BatchLQR) acting for copies consecutive copies of each of the
+    PID or LQR policies, so the actions of all rollouts are computed in one array operation
+    """
+    from policy import PID, LQR, BatchPID, BatchLQR
+    if all(isinstance(p, PID) for p in policies):
+        gains = [np.repeat([np.broadcast_to(getattr(p, k), np.shape(p.target)) for p in policies], copies, axis=0)
+                 for k in ('Kp', 'Kd', 'target')]
+        return BatchPID(*gains, actionBounds=policies[0].bounds)
+    if all(isinstance(p, LQR) for p in policies):
+        K = np.repeat([np.ravel(p.K) for p in policies], copies, axis=0)
+        return BatchLQR(K, actionBounds=policies[0].bounds)
+    raise ValueError("No batch version of the policies " + str({type(p).__name__ for p in policies}))
+
+
+def test_models(test_data, models, verbose=False, env=None, compute_action=False, ret_var=False, t_range=np.inf,
+                propagation=None, num_particles=20):
     """
     Tests each of the models in the dictionary "models" on each of the trajectories in test_data.
     Note: this function uses Numpy arrays to handle multiple tests at once efficiently
@@ -39,6 +142,9 @@ def test_models(test_data, models, verbose=False, env=None, compute_action=False
     ------------
     test_data: the trajectories to test on, N trajectories
     models: a dictionary of models to test, M models
+    propagation: None to propagate the mean of probabilistic one-step models, 'ts1' / 'tsinf'
+                 to propagate num_particles sampled particles per trajectory (see particle_rollout),
+                 or 'mm' to propagate a Gaussian by moment matching (see moment_rollout)
 
     Returns:
      MSEs:           MSEs['x'] is a 2D array where the (i,j)th is the MSE for
@@ -181,6 +287,26 @@ def test_models(test_data, models, verbose=False, env=None, compute_action=False
 
         ind_dict[key] = indices
 
+        if propagation is not None and model.prob and not traj and not lstm:
+            act_fn = None
+            if compute_action:
+                # every rollout (and every particle) has its own controller state, all acting in one call
+                policy = batch_policy(policies, 1 if propagation == 'mm' else num_particles)
+
+                def act_fn(cur):
+                    return policy.act(cur if cur.shape[1] < 5 else cur[:, :5])[0]
+
+            rollout_actions = None if env == 'lorenz' else actions
+            if propagation == 'mm':
+                mean, var = moment_rollout(model, currents[key], int(min(T, t_range)), actions=rollout_actions,
+                                           act_fn=act_fn)
+            else:
+                mean, var, _ = particle_rollout(model, currents[key], int(min(T, t_range)), actions=rollout_actions,
+                                                act_fn=act_fn, num_particles=num_particles, propagation=propagation)
+            predictions[key] = list(mean.transpose(1, 0, 2))
+            variances[key] = list(var[:, 1:].transpose(1, 0, 2))
+            continue
+
         # # temp for plotting one-step
         # if i == 1:
         #     compute_action = False
@@ -535,7 +661,8 @@ def evaluate(cfg):
             entry.actions = entry.actions[0:cfg.plotting.t_range]
 
         MSEs, predictions, variances = test_models(dat, models, env=name, compute_action=cfg.plotting.compute_action,
-                                                   ret_var=True)
+                                                   ret_var=True, propagation=cfg.plotting.propagation or None,
+                                                   num_particles=cfg.plotting.num_particles)
 
         setup_plotting(models)
         mse_evald = []
@@ -20,6 +20,8 @@ import logging
 
 import multiprocessing as mp
 
+from policy import Policy
+
 log = logging.getLogger(__name__)
 
 
@@ -252,6 +254,71 @@ class Ensemble:
         return self
 
 
+class MPC(Policy):
+    """
+    PETS style model predictive control with a one-step (probabilistic ensemble) DynamicsModel.
+    Every step, CEM searches over action sequences; each candidate is rolled out with num_particles particles,
+    each particle fixed to one ensemble member for the whole horizon (TS-inf), and scored by its mean return.
+    The population x particles rollout is one stacked batch, so a step costs horizon x iterations calls to
+    DynamicsModel.predict_particles. The compute budget is population, horizon and iterations.
+    Acts on the full observation (see reacher_pd.run_controller) and warm starts from the shifted previous plan.
+    """
+
+    def __init__(self, model, r_func, dX, dU, actionBounds, horizon=25, population=400, elites=40,
+                 iterations=5, num_particles=20, alpha=0.1):
+        """
+        :param model: one-step DynamicsModel with actions
+        :param r_func: array reward function over (..., D) torch states laid out as model.state_indices,
+                       see reward_rank.reward_function
+        :param actionBounds: (low, high) arrays, also the range the action sequences are sampled in
+        """
+        Policy.__init__(self, dX=dX, dU=dU, actionBounds=actionBounds)
+        self.full_state = True
+        self.model = model
+        self.r_func = r_func
+        self.horizon = horizon
+        self.population = population
+        self.elites = elites
+        self.iterations = iterations
+        self.num_particles = num_particles
+        self.alpha = alpha
+        self.low = np.broadcast_to(np.asarray(actionBounds[0], dtype=np.float32), (horizon, dU))
+        self.high = np.broadcast_to(np.asarray(actionBounds[1], dtype=np.float32), (horizon, dU))
+        self.reset()
+
+    def reset(self):
+        self.plan = (self.low + self.high) / 2
+
+    def evaluate(self, state, sequences):
+        """
+        Mean predicted return of each of the C x horizon x dU action sequences from state
+        """
+        C, P = len(sequences), self.num_particles
+        members = np.tile(self.model.sample_members(P), C)
+        states = torch.from_numpy(np.float32(state)).repeat(C * P, 1)
+        actions = torch.from_numpy(np.float32(sequences)).repeat_interleave(P, dim=0)
+        returns = torch.zeros(C * P)
+        for t in range(self.horizon):
+            states = self.model.predict_particles(torch.cat((states, actions[:, t]), dim=1), members)
+            returns += self.r_func(states)
+        returns[torch.isnan(returns)] = -np.inf
+        return returns.view(C, P).mean(dim=1).numpy()
+
+    def _action(self, x, obs, time, noise):
+        state = x[self.model.state_indices]
+        mean = self.plan
+        std = (self.high - self.low) / 2
+        for it in range(self.iterations):
+            eps = np.random.randn(self.population, self.horizon, self.dU)
+            candidates = np.clip(mean + std * eps, self.low, self.high)
+            returns = self.evaluate(state, candidates)
+            elite = candidates[np.argsort(returns)[::-1][:self.elites]]
+            mean = self.alpha * mean + (1 - self.alpha) * np.mean(elite, axis=0)
+            std = self.alpha * std + (1 - self.alpha) * np.std(elite, axis=0)
+        self.plan = np.concatenate((mean[1:], mean[-1:]))
+        return mean[0]
+
+
 class Model(object):
     """
     A wrapper class for general models, including single nets and ensembles
@@ -222,14 +222,14 @@ class jointsTrajectoryTrackingPID(PID):
 
 
 class LQR(Policy):
-    def __init__(self, A, B, Q, R, actionBounds=None, horizon=10):
+    def __init__(self, A, B, Q, R, actionBounds=None, horizon=10, K=None):
         '''
         :param n_dof:
         :param trajectory:
         :param horizon: Horizon
+        :param K: a precomputed gain, skips solving the Riccati equation
         '''
         Policy.__init__(self, dX=np.shape(A)[1], dU=np.shape(B)[1], actionBounds=actionBounds)
-        from control import lqr
         # from scipy.linalg import solve_continuous_are, solve_discrete_are
         self.T = horizon
         self.A = A
@@ -238,7 +238,10 @@ class LQR(Policy):
         self.R = R
         # self.controller = self.compute_controller()
         # self.K = solve_continuous_are(A, B, Q, R)
-        self.K, S, E = lqr(A, B, Q, R)
+        if K is None:
+            from control import lqr
+            K, S, E = lqr(A, B, Q, R)
+        self.K = K
 
     def compute_controller(self):
         # TODO: implement me!!!
@@ -252,3 +255,60 @@ class LQR(Policy):
         u = -np.matmul(self.K, x)
         return np.array(u).squeeze()
         # return self.controller.action(x, obs, time, noise)
+
+
+class BatchLQR(Policy):
+    def __init__(self, K, actionBounds=None):
+        '''
+        M linear feedback controllers u_m = -K_m x_m evaluated together, e.g. LQR gains with per-trial modifiers
+        :param K: M x dX gains, one row per controller
+        '''
+        K = np.atleast_2d(K)
+        Policy.__init__(self, dX=np.shape(K)[1], dU=1, actionBounds=actionBounds)
+        self.K = K
+
+    def act(self, x, obs=None, time=None, noise=None):
+        """
+        :param x: M x dX states, row m is acted on with gain K[m]
+        :return:
+            a: M x 1 actions
+            t: scalar amount of time used to compute the M actions
+        """
+        start = timer()
+        x = np.atleast_2d(x)
+        assert x.shape == self.K.shape, 'Wrong shape states %s, should be %s' % (x.shape, self.K.shape)
+        # one 1 x dX by dX x 1 product per row, summed in the same order as LQR
+        a = -np.matmul(self.K[:, None, :], x[:, :, None])[:, :, 0]
+        if self.bounds is not None:
+            a = np.clip(a, self.bounds[0], self.bounds[1])
+        return a, timer() - start
+
+
+class BatchPID(Policy):
+    def __init__(self, P, D, target, actionBounds=None):
+        '''
+        M PID controllers evaluated together, without the integral term (as in PID)
+        :param P: M x dU proportional gains, one row per controller
+        :param D: M x dU derivative gains
+        :param target: M x dU setpoints
+        '''
+        self.Kp, self.Kd, self.target = np.atleast_2d(P), np.atleast_2d(D), np.atleast_2d(target)
+        Policy.__init__(self, dX=np.shape(self.target)[1], dU=np.shape(self.target)[1], actionBounds=actionBounds)
+        self.prev_error = np.zeros(np.shape(self.target))
+
+    def act(self, x, obs=None, time=None, noise=None):
+        """
+        :param x: M x dX states, row m is acted on by controller m
+        :return:
+            a: M x dU actions
+            t: scalar amount of time used to compute the M actions
+        """
+        start = timer()
+        x = np.atleast_2d(x)
+        assert x.shape == self.target.shape, 'Wrong shape states %s, should be %s' % (x.shape, self.target.shape)
+        error = self.target - x
+        a = self.Kp * error + self.Kd * (error - self.prev_error)
+        self.prev_error = error
+        if self.bounds is not None:
+            a = np.clip(a, self.bounds[0], self.bounds[1])
+        return a, timer() - start
@@ -12,6 +12,7 @@ from dotmap import DotMap
 from sklearn.utils import shuffle
 
 from timeit import default_timer as timer
+import multiprocessing as mp
 import matplotlib.pyplot as plt
 
 import mujoco_py
@@ -33,6 +34,7 @@ from policy import PID
 from plot import plot_reacher, plot_loss, setup_plotting
 
 from dynamics_model import DynamicsModel
+from trajectory_store import TrajectoryList, TrajectoryWriter
 
 
 ###########################################
@@ -153,7 +155,8 @@ def run_controller(env, horizon, policy, video=False):
 
     :param env: A gym object
     :param horizon: The number of states forward to look
-    :param policy: A policy object (see other python file)
+    :param policy: A policy object (see other python file), policies with full_state set act on the
+                   full observation instead of the joint positions
     """
 
     # WHat is going on here?
@@ -169,12 +172,16 @@ def run_controller(env, horizon, policy, video=False):
     logs.rewards = []
     logs.times = []
 
+    full_state = getattr(policy, 'full_state', False)
+    if hasattr(policy, 'reset'):
+        policy.reset()
+
     observation = env.reset()
     for i in range(horizon):
         if (video):
             env.render()
         state = observation
-        action, t = policy.act(obs2q(state))
+        action, t = policy.act(state if full_state else obs2q(state))
 
         # print(action)
 
@@ -184,7 +191,7 @@ def run_controller(env, horizon, policy, video=False):
             return logs
 
         # Log
-        # logs.times.append()
+        logs.times.append(t)
         logs.actions.append(action)
         logs.rewards.append(reward)
         logs.states.append(observation.squeeze())
@@ -194,37 +201,91 @@ def run_controller(env, horizon, policy, video=False):
     logs.actions = np.array(logs.actions)
     logs.rewards = np.array(logs.rewards)
     logs.states = np.array(logs.states)
+    logs.times = np.array(logs.times)
     return logs
 
 
-def collect_data(cfg, plot=False):  # Creates horizon^2/2 points
+def run_mpc(cfg):
+    """
+    Runs the reacher with a PETS style MPC planner on a learned one-step model (see mbrl_resources.MPC)
+    :return: an array of DotMaps, one per trial
     """
-    Collect data for environment model
+    from mbrl_resources import MPC
+    from reward_rank import reward_function
+
+    if cfg.mpc.threads:
+        torch.set_num_threads(cfg.mpc.threads)
+    f = hydra.utils.get_original_cwd() + '/models/reacher/'
+    if cfg.exper_dir:
+        f = f + cfg.exper_dir + '/'
+    model = torch.load(f + cfg.mpc.model + '.dat')
+    if model.traj:
+        raise ValueError("MPC needs a one-step model")
+
+    env = gym.make(cfg.env.name)
+    policy = MPC(model, reward_function('reacher', model.state_indices), dX=env.observation_space.shape[0], dU=cfg.env.action_size,
+                 actionBounds=(env.action_space.low, env.action_space.high), horizon=cfg.mpc.horizon,
+                 population=cfg.mpc.population, elites=cfg.mpc.elites, iterations=cfg.mpc.iterations,
+                 num_particles=cfg.mpc.num_particles, alpha=cfg.mpc.alpha)
+
+    logs = []
+    for i in range(cfg.mpc.trials):
+        env.seed(i)
+        dotmap = run_controller(env, horizon=cfg.trial_timesteps, policy=policy, video=cfg.video)
+        log.info(f"Trial {i}: return {np.sum(dotmap.rewards):.3f}, "
+                 f"step compute mean {np.mean(dotmap.times) * 1000:.1f}ms, max {np.max(dotmap.times) * 1000:.1f}ms")
+        logs.append(dotmap)
+    return logs
+
+
+def _init_reacher_worker(env_name, horizon, video=False):
+    # one persistent environment per collection process, MuJoCo models are slow to load
+    global _reacher_worker
+    _reacher_worker = (gym.make(env_name), horizon, video)
+
+
+def _run_reacher_trial(spec):
+    """
+    Runs one collection trial on the process' environment, see _init_reacher_worker
+    :param spec: (seed, P, I, D, target) of the trial, sampled in the main process
+    """
+    env, horizon, video = _reacher_worker
+    seed, P, I, D, target = spec
+    env.seed(seed)
+    env.reset()
+    policy = PID(dX=5, dU=5, P=P, I=I, D=D, target=target)
+    dotmap = run_controller(env, horizon=horizon, policy=policy, video=video)
+
+    dotmap.target = target
+    dotmap.P = P / 5
+    dotmap.I = I
+    dotmap.D = D
+    return dotmap
+
+
+def collect_data(cfg, plot=False, writer=None):  # Creates horizon^2/2 points
+    """
+    Collect data for environment model. The trial specs (seed, P, I, D, target) are sampled here and the trials
+    are run on cfg.processes worker processes with one environment each (0 uses every core), the results are
+    streamed back in trial order
     :param nTrials:
     :param horizon:
+    :param writer: a trajectory_store.TrajectoryWriter every finished trajectory is written to as it
+                   finishes, so an interrupted run can resume: trials already in it are skipped. The returned
+                   trajectories are still read back into memory
     :return: an array of DotMaps, where each DotMap contains info about a trajectory
     """
 
     env_model = cfg.env.name
-    env = gym.make(env_model)
     # if (cfg.video):
     # env = Monitor(env, hydra.utils.get_original_cwd() + '/trajectories/reacher/video',
     # video_callable = lambda episode_id: episode_id==1,force=True)
     log.info('Initializing env: %s' % env_model)
 
-    # Logs is an array of dotmaps, each dotmap contains 2d np arrays with data
-    # about <horizon> steps with actions, rewards and states
-    logs = []
+    specs = []
     if (cfg.PID_test):
         target = np.random.rand(5) * 2 - 1
     for i in range(cfg.num_trials):
-        log.info('Trial %d' % i)
-        if (cfg.PID_test):
-            env.seed(0)
-        else:
-            env.seed(i)
-        s0 = env.reset()
-
         # P = np.array([4, 4, 1, 1, 1])
         P = np.random.rand(5) * 5
         I = np.zeros(5)
@@ -234,16 +295,27 @@ def collect_data(cfg, plot=False):  # Creates horizon^2/2 points
         # Samples target uniformely from [-1, 1]
         if (not cfg.PID_test):
             target = np.random.rand(5) * 2 - 1
+        specs.append((0 if cfg.PID_test else i, P, I, D, target))
 
-        policy = PID(dX=5, dU=5, P=P, I=I, D=D, target=target)
-        # print(type(env))
-        dotmap = run_controller(env, horizon=cfg.trial_timesteps, policy=policy, video=cfg.video)
-
-        dotmap.target = target
-        dotmap.P = P / 5
-        dotmap.I = I
-        dotmap.D = D
-        logs.append(dotmap)
+    # Logs is an array of dotmaps, each dotmap contains 2d np arrays with data
+    # about <horizon> steps with actions, rewards and states
+    logs = writer if writer is not None else TrajectoryList()
+    pending = [i for i in range(cfg.num_trials) if i not in logs.trials]
+    specs = [specs[i] for i in pending]
+    processes = 1 if cfg.video else min(cfg.get('processes', 1) or mp.cpu_count(), max(len(specs), 1))
+    initargs = (env_model, cfg.trial_timesteps, cfg.video)
+    if processes > 1:
+        log.info('Collecting on %d processes' % processes)
+        with mp.Pool(processes, initializer=_init_reacher_worker, initargs=initargs) as pool:
+            for i, dotmap in zip(pending, pool.imap(_run_reacher_trial, specs)):
+                log.info('Trial %d' % i)
+                logs.append(i, dotmap)
+    else:
+        _init_reacher_worker(*initargs)
+        for i, spec in zip(pending, specs):
+            log.info('Trial %d' % i)
+            logs.append(i, _run_reacher_trial(spec))
+    logs = logs.read()
 
     if plot:
         import plotly.graph_objects as go
@@ -306,16 +378,25 @@ def contpred(cfg):
 
     train = cfg.mode == 'train'
 
+    if cfg.mode == 'mpc':
+        run_mpc(cfg)
+        return
+
     # Collect data
     if not train:
         log.info(f"Collecting new trials")
 
-        exper_data = collect_data(cfg)
-        test_data = collect_data(cfg)
+        f = hydra.utils.get_original_cwd() + '/trajectories/reacher/' + 'raw' + cfg.data_dir
+        writers = [TrajectoryWriter(f + split, resume=cfg.resume) for split in ('.exper', '.test')]
+        log.info(f"Streaming trajectories to {f}.exper and {f}.test")
+        exper_data = collect_data(cfg, writer=writers[0])
+        test_data = collect_data(cfg, writer=writers[1])
+        [w.close() for w in writers]
 
         log.info("Saving new default data")
-        torch.save((exper_data, test_data),
-                   hydra.utils.get_original_cwd() + '/trajectories/reacher/' + 'raw' + cfg.data_dir)
+        torch.save((exper_data, test_data), f)
+        # the saved file replaces the stores of this collection
+        [w.remove() for w in writers]
         log.info(f"Saved trajectories to {'/trajectories/reacher/' + 'raw' + cfg.data_dir}")
     # Load data
     else:
@@ -357,6 +438,12 @@ def contpred(cfg):
 
             model = DynamicsModel(cfg)
             train_logs, test_logs = model.train(dataset, cfg)
+            if traj and cfg.model.training.get('reward_head', False):
+                from reward_rank import create_dataset_reward
+                log.info("Training reward head")
+                model.train_reward(create_dataset_reward(exper_data, cfg.env.label, model,
+                                                         threshold=cfg.model.training.filter_rate,
+                                                         t_range=cfg.model.training.t_range), cfg)
 
             setup_plotting({cfg.model.str: model})
             plot_loss(train_logs, test_logs, cfg, save_loc=cfg.env.name + '-' + cfg.model.str, show=False)
@@ -16,7 +16,6 @@ import torch
 import numpy as np
 
 from plot import *
-from evaluate import test_models
 import gpytorch
 from mbrl_resources import obs2q
 
@@ -49,20 +48,126 @@ def get_reward_cf(state, action):
     return reward
 
 
+def get_reward_reacher_batch(states, actions=None, columns=(18, 19, 20)):
+    # array version of get_reward_reacher over (..., D) numpy arrays or torch tensors, e.g. N x T x D
+    # trajectories, differentiable for tensors. columns hold fingertip - goal, see reward_function
+    vec = states[..., list(columns)]
+    if torch.is_tensor(states):
+        return -torch.norm(vec, dim=-1)
+    return -np.linalg.norm(vec, axis=-1)
+
+
+def get_reward_cp_batch(states, actions=None, columns=(0, 2)):
+    # array version of get_reward_cp over (..., D) numpy arrays or torch tensors, e.g. N x T x D
+    # trajectories, differentiable for tensors
+    return -(states[..., columns[0]] ** 2 + states[..., columns[1]] ** 2)
+
+
+def get_reward_cf_batch(states, actions=None, columns=(3, 4)):
+    # array version of get_reward_cf over (..., D) numpy arrays or torch tensors, e.g. N x T x D
+    # trajectories, differentiable for tensors
+    return -states[..., columns[0]] ** 2 - states[..., columns[1]] ** 2
+
+
+batch_rewards = {
+    'reacher': get_reward_reacher_batch,
+    'cartpole': get_reward_cp_batch,
+    'crazyflie': get_reward_cf_batch,
+}
+
+# observation size of each environment and the observation columns its reward is computed from, the reacher
+# reward is the distance of the fingertip to the goal, observations 18-20 (fingertip - goal)
+reward_layouts = {
+    'reacher': (21, [18, 19, 20]),
+    'cartpole': (4, [0, 2]),
+    'crazyflie': (9, [3, 4]),
+}
+
+
+def reward_function(label, state_indices=None):
+    """
+    The array reward function of an environment for states laid out as state_indices, e.g. the states predicted
+    by a model with model.state_indices. Raises a ValueError if those states do not hold the columns the reward
+    is computed from, and the returned function raises one for states of any other width
+    :param state_indices: the observation columns of the states, None for full observations
+    :return: r_func(states, actions=None) over (..., D) numpy arrays or torch tensors
+    """
+    if label not in batch_rewards:
+        raise ValueError("No reward for environment " + str(label))
+    size, columns = reward_layouts[label]
+    state_indices = list(range(size)) if state_indices is None else [int(i) for i in state_indices]
+    missing = [c for c in columns if c not in state_indices]
+    if missing:
+        raise ValueError(f"The {label} reward is computed from observations {columns}, "
+                         f"states with observations {state_indices} lack {missing}")
+    columns = [state_indices.index(c) for c in columns]
+    r_func = batch_rewards[label]
+
+    def reward(states, actions=None):
+        if states.shape[-1] != len(state_indices):
+            raise ValueError(f"The {label} reward expects states with observations {state_indices}, "
+                             f"got {states.shape[-1]} columns")
+        return r_func(states, actions, columns=columns)
+
+    return reward
+
+
+def traj_params(traj, label, model):
+    # control parameters of a recorded trajectory, laid out as in the trajectory model input
+    if label == 'cartpole':
+        return np.array(traj.K).flatten()
+    dat = []
+    if model.control_params:
+        dat.extend([traj.P, traj.D])
+    if model.train_target:
+        dat.append(traj.target)
+    return np.hstack(dat)
+
+
+def create_dataset_reward(data, label, model, threshold=0.0, t_range=0):
+    """
+    Creates a dataset for the reward head of a trajectory model (see DynamicsModel.train_reward).
+    The inputs match create_dataset_traj, (states[i], j - i, control params), and the target is the reward
+    accumulated over states[i+1..j], computed once per trajectory with a cumulative sum.
+
+    Parameters:
+    -----------
+    data: An array of dotmaps where each dotmap has info about a trajectory
+    model: the trajectory model, for the control parameter layout
+    threshold: the probability of dropping a given data entry
+    """
+    # rewards of the recorded (full observation) states
+    r_func = reward_function(label)
+    data_in, data_out = [], []
+    for id, traj in enumerate(data):
+        states = traj.states
+        if t_range > 0:
+            states = states[:t_range]
+        # same trajectories as create_dataset_traj
+        if id > 99:
+            continue
+        n = states.shape[0]
+        cum = np.concatenate(([0], np.cumsum(r_func(states))))
+        i, j = np.triu_indices(n, k=1)
+        keep = np.random.random(len(i)) >= threshold
+        i, j = i[keep], j[keep]
+        params = np.tile(traj_params(traj, label, model), (len(i), 1))
+        data_in.append(np.hstack((states[i], (j - i).reshape(-1, 1), params)))
+        data_out.append(cum[j + 1] - cum[i + 1])
+
+    data_in = np.array(np.concatenate(data_in), dtype=np.float32)
+    data_out = np.array(np.concatenate(data_out), dtype=np.float32).reshape(-1, 1)
+    return data_in, data_out
+
+
 def get_reward(predictions, actions, r_function):
-    # takes in the predicted trajectory and returns the reward
+    # takes in the predicted trajectories (N x T x D per model) and returns the cumulative reward of each
+    # trajectory with its mean and std, r_function is an array reward function (see batch_rewards)
     rewards = {}
-    num_traj = len(actions)
+    actions = np.asarray(actions)
     for m_label, state_data in predictions.items():
-        r = []
-        for i in range(num_traj):
-            r_sub = 0
-            cur_states = state_data[i]
-            cur_actions = actions[i]
-            for s, a in zip(cur_states, cur_actions):
-                # TODO need a specific get reward function for the reacher env
-                r_sub += r_function(s, a)
-            r.append(r_sub)
+        T = min(np.shape(state_data)[1], np.shape(actions)[1])
+        r = np.sum(r_function(np.asarray(state_data)[:, :T], actions[:, :T]), axis=1)
         rewards[m_label] = (r, np.mean(r), np.std(r))
 
     return rewards
@@ -190,6 +295,77 @@ def pred_traj(test_data, models, control=None, env=None, cfg=None, t_range=None)
     return 0, predictions
 
 
+def closed_loop_actions(test_data, label, cfg=None):
+    """
+    Rebuilds the controllers of the recorded trajectories from their parameters
+    :return: act(states), the actions of all N controllers for N x D (model) states in one array operation
+    """
+    if label == 'cartpole':
+        # LQR, u = -K x within the action bounds
+        K = np.stack([np.array(t.K).flatten() for t in test_data])
+
+        def act(states):
+            return np.clip(-np.sum(K * states[:, :K.shape[1]], axis=1, keepdims=True), -1.0, 1.0)
+
+    elif label == 'reacher':
+        # PD on the joints, collect_data saves P / 5
+        P = np.stack([t.P for t in test_data]) * 5
+        D = np.stack([t.D for t in test_data])
+        target = np.stack([t.target for t in test_data])
+        prev_error = [np.zeros_like(target)]
+
+        def act(states):
+            error = target - states[:, :5]
+            u = P * error + D * (error - prev_error[0])
+            prev_error[0] = error
+            return u
+
+    elif label == 'crazyflie':
+        from crazyflie_pd import PidPolicy
+        policies = [PidPolicy([[t.P[0], 0, t.D[0]], [t.P[1], 0, t.D[1]]], cfg.pid) for t in test_data]
+
+        def act(states):
+            return np.stack([p.get_action(s[3:6]) for s, p in zip(states, policies)]).reshape(-1, 4)
+
+    else:
+        raise ValueError("No controllers for environment " + str(label))
+    return act
+
+
+def rollout_plan(test_data, model_one, model_traj, label, cfg=None, t_range=np.inf):
+    """
+    All predictions needed for reward ranking at the cost of a single rollout. The one-step model runs open loop
+    on the recorded actions and closed loop with the recorded controllers as one stacked 2N batch per step,
+    the trajectory model predicts the full horizon of every trajectory in one call.
+
+    Returns:
+        open_loop, closed_loop: N x T x D one-step model predictions
+        traj: N x T x D trajectory model predictions
+    """
+    states = np.stack([t.states for t in test_data])
+    actions = np.stack([t.actions for t in test_data])
+    if actions.ndim == 2:
+        actions = np.expand_dims(actions, axis=2)
+    N = len(test_data)
+    T = int(min(states.shape[1], t_range))
+    act = closed_loop_actions(test_data, label, cfg)
+
+    s0 = states[:, 0, model_one.state_indices]
+    current = np.concatenate((s0, s0))
+    one_step = [current]
+    for i in range(1, T):
+        acts = np.concatenate((actions[:, i - 1], act(current[N:])))
+        current = model_one.predict(np.hstack((current, acts))).detach().numpy()
+        one_step.append(current)
+    one_step = np.stack(one_step, axis=1)
+
+    s0 = states[:, 0, model_traj.state_indices]
+    params = np.stack([traj_params(t, label, model_traj) for t in test_data])
+    traj = model_traj.predict(model_traj.traj_input(s0, params, T - 1)).detach().numpy()
+    traj = np.concatenate((s0[:, None], traj.reshape((N, T - 1, -1))), axis=1)
+    return one_step[:N], one_step[N:], traj
+
+
 def train_gp(data):
     class ExactGPModel(gpytorch.models.ExactGP):
         def __init__(self, train_x, train_y, likelihood):
@@ -242,6 +418,80 @@ def train_gp(data):
     return model, likelihood
 
 
+def train_svgp(data, num_inducing=500, batch=1024, epochs=20, lr=.01):
+    """
+    Sparse variational GP for the reward baseline, O(n m^2) per epoch with m inducing points instead of the
+    O(n^3) exact GP, trained on minibatches of the ELBO so it scales to tens of thousands of trials.
+    The targets are standardized, predict_svgp undoes it.
+    """
+
+    class SVGPModel(gpytorch.models.ApproximateGP):
+        def __init__(self, inducing_points):
+            variational_distribution = gpytorch.variational.CholeskyVariationalDistribution(
+                inducing_points.size(0))
+            variational_strategy = gpytorch.variational.VariationalStrategy(
+                self, inducing_points, variational_distribution, learn_inducing_locations=True)
+            super(SVGPModel, self).__init__(variational_strategy)
+            self.mean_module = gpytorch.means.ConstantMean()
+            self.covar_module = gpytorch.kernels.ScaleKernel(
+                gpytorch.kernels.RBFKernel(ard_num_dims=inducing_points.size(1)))
+
+        def forward(self, x):
+            mean_x = self.mean_module(x)
+            covar_x = self.covar_module(x)
+            return gpytorch.distributions.MultivariateNormal(mean_x, covar_x)
+
+    from torch.utils.data import TensorDataset, DataLoader
+    train_x, train_y = data
+    y_mean, y_std = train_y.mean(), train_y.std()
+    train_y = (train_y - y_mean) / y_std
+
+    # initialize the inducing points on a random subset of the data
+    inducing = train_x[torch.randperm(len(train_x))[:num_inducing]].clone()
+    model = SVGPModel(inducing)
+    model.y_mean, model.y_std = y_mean, y_std
+    likelihood = gpytorch.likelihoods.GaussianLikelihood()
+
+    model.train()
+    likelihood.train()
+    optimizer = torch.optim.Adam([
+        {'params': model.parameters()},
+        {'params': likelihood.parameters()},
+    ], lr=lr)
+    mll = gpytorch.mlls.VariationalELBO(likelihood, model, num_data=len(train_y))
+
+    loader = DataLoader(TensorDataset(train_x, train_y), batch_size=batch, shuffle=True)
+    for i in range(epochs):
+        epoch_loss = 0
+        for x_batch, y_batch in loader:
+            optimizer.zero_grad()
+            loss = -mll(model(x_batch), y_batch)
+            loss.backward()
+            optimizer.step()
+            epoch_loss += loss.item() / len(loader)
+        log.info(f"SVGP epoch {i + 1}/{epochs}, loss {epoch_loss:.3f}")
+
+    return model, likelihood
+
+
+def predict_svgp(test_x, model, likelihood, batch=4096):
+    """
+    Batched posterior prediction of a GP from train_svgp
+    :return: mean and variance of the predicted rewards (in the original units)
+    """
+    model.eval()
+    likelihood.eval()
+    means, variances = [], []
+    with torch.no_grad(), gpytorch.settings.fast_pred_var():
+        for x_batch in torch.split(test_x, batch):
+            observed_pred = likelihood(model(x_batch))
+            means.append(observed_pred.mean)
+            variances.append(observed_pred.variance)
+    mean = torch.cat(means) * model.y_std + model.y_mean
+    var = torch.cat(variances) * model.y_std ** 2
+    return mean, var
+
+
 def predict_gp(test_x, model, likelihood, train_x=None, train_y=None):
     # Get into evaluation (predictive posterior) mode
     model.eval()
@@ -280,6 +530,7 @@ def reward_rank(cfg):
         raise ValueError("No Reward in Lorenz System")
 
     label = cfg.env.label
+    r_func = reward_function(label)
     graph_file = 'Plots'
     os.mkdir(graph_file)
 
@@ -306,24 +557,16 @@ def reward_rank(cfg):
 
     if label == 'reacher':
         control = [np.concatenate((t['D'], t['P'], t['target'])) for t in data_train]
-        r_func = get_reward_reacher
     elif cfg.env.label == 'cartpole':
         for vec_s, vec_a in zip(states, actions):
             vec_s[0, 1] = vec_s[0, 1].item()
             vec_s[0, 3] = vec_s[0, 3].item()
             vec_a[1] = vec_a[1].item()
         control = [t['K'] for t in data_train]
-        r_func = get_reward_cp
     elif cfg.env.label == 'crazyflie':
         control = [np.concatenate((t['D'], t['P'], t['target'])) for t in data_train]
-        r_func = get_reward_cf
 
-    reward = [np.sum([r_func(s, a) for s, a in zip(sta, act)]) for sta, act in zip(states, actions)]
-
-    from botorch.models import SingleTaskGP
-    from botorch.fit import fit_gpytorch_model
-    from botorch.utils import standardize
-    from gpytorch.mlls import ExactMarginalLogLikelihood
+    reward = get_reward({'true': np.stack(states)}, actions, r_func)['true'][0]
 
     # train_X = torch.rand(10, 2)
     # Y = 1 - torch.norm(train_X - 0.5, dim=-1, keepdim=True)
@@ -344,10 +587,19 @@ def reward_rank(cfg):
     gp_y_train = gp_y[:split]
     # model, likelihood = train_gp((torch.stack(gp_x_train), gp_y_train))
 
-    log.info(f"Training GP model (can be slow)")
-    gp = SingleTaskGP(torch.stack(gp_x_train), gp_y_train.reshape(-1, 1))
-    mll = ExactMarginalLogLikelihood(gp.likelihood, gp)
-    fit_gpytorch_model(mll)
+    if cfg.gp.sparse:
+        log.info(f"Training sparse variational GP model ({cfg.gp.num_inducing} inducing points)")
+        gp, gp_likelihood = train_svgp((torch.stack(gp_x_train), gp_y_train), num_inducing=cfg.gp.num_inducing,
+                                       batch=cfg.gp.batch, epochs=cfg.gp.epochs, lr=cfg.gp.lr)
+    else:
+        from botorch.models import SingleTaskGP
+        from botorch.fit import fit_gpytorch_model
+        from gpytorch.mlls import ExactMarginalLogLikelihood
+
+        log.info(f"Training GP model (can be slow)")
+        gp = SingleTaskGP(torch.stack(gp_x_train), gp_y_train.reshape(-1, 1))
+        mll = ExactMarginalLogLikelihood(gp.likelihood, gp)
+        fit_gpytorch_model(mll)
 
     # gp_x_test = gp_x[split:]
     # gp_y_test = gp_y[split:] # TRUE REWARD
@@ -369,55 +621,42 @@ def reward_rank(cfg):
 
     if label == 'reacher':
         control = [np.concatenate((t['D'], t['P'], t['target'])) for t in data_test]
-        r_func = get_reward_reacher
     elif cfg.env.label == 'cartpole':
         for vec_s, vec_a in zip(states, actions):
             vec_s[0, 1] = vec_s[0, 1].item()
             vec_s[0, 3] = vec_s[0, 3].item()
             vec_a[1] = vec_a[1].item()
         control = [t['K'] for t in data_test]
-        r_func = get_reward_cp
     elif cfg.env.label == 'crazyflie':
         control = [np.concatenate((t['D'], t['P'], t['target'])) for t in data_test]
-        r_func = get_reward_cf
 
-    reward = [np.sum([r_func(s, a) for s, a in zip(sta, act)]) for sta, act in zip(states, actions)]
+    reward = get_reward({'true': np.stack(states)}, actions, r_func)['true'][0]
 
     log.info("Evaluating GP")
     gp_x_test = [torch.Tensor(np.concatenate((s[0], c))) for s, c in zip(states, control)]
     # gp_pred_test = predict_gp(torch.stack(gp_x_test), model, likelihood)
     # gp_pred_test = gp.forward(torch.stack(gp_x_test))
-    gp_pred_test = gp.posterior(torch.stack(gp_x_test))
-    # predict with one step and traj model
-    models = {
-        'p': model_one,
-        't': model_traj,
-    }
-    MSEs, predictions = test_models(data_test, models, env=cfg.env.label, t_range=cfg.model.training.t_range)
-
-    # get dict of rewards for type of model
-    pred_rewards = get_reward(predictions, actions, r_func)
-
-    models_step = {
-        'p': model_one,
-    }
-
-    _, pred_drift = pred_traj(data_test, models_step, env=cfg.env.label, cfg=cfg, t_range=cfg.model.training.t_range)
+    if cfg.gp.sparse:
+        gp_pr_test = predict_svgp(torch.stack(gp_x_test), gp, gp_likelihood)[0].numpy()
+    else:
+        gp_pr_test = gp.posterior(torch.stack(gp_x_test)).mean.detach().numpy()
+    # predict with one step (open and closed loop) and traj model
+    open_loop, closed_loop, traj_pred = rollout_plan(data_test, model_one, model_traj, label, cfg=cfg,
+                                                     t_range=cfg.model.training.t_range)
+    pred_drift = {'p': closed_loop}
 
     # get dict of rewards for type of model
-    if cfg.model.training.t_range < np.shape(states)[1]:
-        for key in pred_drift:
-            pred_drift[key] = pred_drift[key][:, :cfg.model.training.t_range, :]
-        actions = [a[:cfg.model.training.t_range, :] for a in actions]
-
-    pred_rewards_true = get_reward(pred_drift, actions, r_func)
+    # the predictions are laid out as the state_indices of their model
+    r_one = reward_function(label, model_one.state_indices)
+    pred_rewards = get_reward({'p': open_loop}, actions, r_one)
+    pred_rewards.update(get_reward({'t': traj_pred}, actions, reward_function(label, model_traj.state_indices)))
+    pred_rewards_true = get_reward(pred_drift, actions, r_one)
 
     if label == 'reacher' or label == 'crazyflie':
         cum_reward = [np.sum(rew) for rew in reward]
     else:
         cum_reward = reward
 
-    gp_pr_test = gp_pred_test.mean.detach().numpy()
     nn_step_oracle = pred_rewards['p'][0]
     nn_step_drift = pred_rewards_true['p'][0]
     nn_traj = pred_rewards['t'][0]
@@ -431,6 +670,16 @@ def reward_rank(cfg):
     print(f"Mean traj reward err: {np.mean((cum_reward - np.array(nn_traj)) ** 2)}")
     print(f" - std dev:{np.std(np.array(nn_traj) - cum_reward)}")
 
+    if getattr(model_traj, 'reward_net', None) is not None:
+        # one batched call for the returns of all test trajectories
+        initials = np.stack([s[0] for s in states])
+        horizon = np.full((len(states), 1), len(states[0]) - 1)
+        params = np.stack([traj_params(t, label, model_traj) for t in data_test])
+        x = np.hstack((initials[:, model_traj.state_indices], horizon, params))
+        nn_traj_head = r_func(initials) + model_traj.predict_reward(x).detach().numpy()
+        print(f"Mean traj reward head err: {np.mean((cum_reward - nn_traj_head) ** 2)}")
+        print(f" - std dev:{np.std(nn_traj_head - cum_reward)}")
+
     arr = np.stack(
         sorted(zip(cum_reward, gp_pr_test, np.array(nn_step_oracle), np.array(nn_traj), np.array(nn_step_drift))))
     # arr = np.stack((cum_reward, gp_pr_test, nn_step, nn_traj))
@@ -27,6 +27,7 @@ from plot import plot_ss, plot_loss, setup_plotting
 
 from dynamics_model import DynamicsModel
 from reacher_pd import run_controller
+from trajectory_store import TrajectoryList, TrajectoryWriter
 
 
 ###########################################
@@ -110,11 +111,14 @@ def create_dataset_step(data, delta=True, t_range=0):
     return data_in, data_out
 
 
-def collect_data_ss(cfg, plot=False):  # Creates horizon^2/2 points
+def collect_data_ss(cfg, plot=False, writer=None):  # Creates horizon^2/2 points
     """
     Collect data for environment model
     :param nTrials:
     :param horizon:
+    :param writer: a trajectory_store.TrajectoryWriter every finished trajectory is written to as it
+                   finishes, so an interrupted run can resume: trials already in it are skipped. The returned
+                   trajectories are still read back into memory
     :return: an array of DotMaps, where each DotMap contains info about a trajectory
     """
 
@@ -129,10 +133,12 @@ def collect_data_ss(cfg, plot=False):  # Creates horizon^2/2 points
 
     # Logs is an array of dotmaps, each dotmap contains 2d np arrays with data
     # about <horizon> steps with actions, rewards and states
-    logs = []
+    logs = writer if writer is not None else TrajectoryList()
 
     s = np.random.randint(0, 100)
     for i in range(cfg.num_trials):
+        if i in logs.trials:
+            continue
         log.info('Trial %d' % i)
         if (cfg.PID_test):
             env.seed(0)
@@ -147,10 +153,34 @@ def collect_data_ss(cfg, plot=False):  # Creates horizon^2/2 points
         if plot: plot_ss(dotmap.states, dotmap.actions, save=True)
 
         # dotmap.K = np.array(policy.K).flatten()
-        logs.append(dotmap)
+        logs.append(i, dotmap)
         s += 1
 
-    return logs
+    return logs.read()
+
+
+def collect_data_ss_batch(cfg, plot=False, writer=None):
+    """
+    collect_data_ss with all trials simulated together through StateSpaceEnv.rollout, the random actions of
+    randomPolicy are drawn for every trial and step up front. Draws the same dataset as collect_data_ss: its
+    seed advances twice per collected trial and run_controller resets the env a second time after seeding
+    :param writer: see collect_data_ss
+    :return: an array of DotMaps, where each DotMap contains info about a trajectory
+    """
+    env_model = cfg.env.name
+    env = gym.make(env_model)
+    env.setup(cfg)
+    log.info('Initializing env: %s, %d trials' % (env_model, cfg.num_trials))
+
+    logs = writer if writer is not None else TrajectoryList()
+    pending = np.array([i for i in range(cfg.num_trials) if i not in logs.trials], dtype=int)
+    s = np.random.randint(0, 100)
+    seeds = [0] * len(pending) if cfg.PID_test else s + pending + np.arange(len(pending))
+    actions = cfg.env.params.variance * np.random.rand(len(pending), cfg.trial_timesteps, env.du)
+    for i, dotmap in zip(pending, env.rollout(env.initial_states(seeds, resets=2), actions)):
+        logs.append(i, dotmap)
+        if plot: plot_ss(dotmap.states, dotmap.actions, save=True)
+    return logs.read()
 
 
 ###########################################
@@ -178,12 +208,18 @@ def contpred(cfg):
     if cfg.mode == 'collect':
         log.info(f"Collecting new trials")
 
-        exper_data = collect_data_ss(cfg, plot=cfg.plot)
-        test_data = collect_data_ss(cfg, plot=cfg.plot)
+        collect = collect_data_ss_batch if cfg.batch and not cfg.video else collect_data_ss
+        f = hydra.utils.get_original_cwd() + '/trajectories/ss/' + 'raw' + cfg.data_dir
+        writers = [TrajectoryWriter(f + split, resume=cfg.resume) for split in ('.exper', '.test')]
+        log.info(f"Streaming trajectories to {f}.exper and {f}.test")
+        exper_data = collect(cfg, plot=cfg.plot, writer=writers[0])
+        test_data = collect(cfg, plot=cfg.plot, writer=writers[1])
+        [w.close() for w in writers]
 
         log.info("Saving new default data")
-        torch.save((exper_data, test_data),
-                   hydra.utils.get_original_cwd() + '/trajectories/ss/' + 'raw' + cfg.data_dir)
+        torch.save((exper_data, test_data), f)
+        # the saved file replaces the stores of this collection
+        [w.remove() for w in writers]
         log.info(f"Saved trajectories to {'/trajectories/ss/' + 'raw' + cfg.data_dir}")
     # Load data
     else:
@@ -0,0 +1,41 @@
+import numpy as np
+import pytest
+from omegaconf import OmegaConf
+
+import cartpole_lqr
+from envs.cartpole import CartPoleContEnv, BatchCartPoleContEnv
+from policy import LQR, BatchLQR
+from reacher_pd import run_controller
+
+
+def test_batch_env_matches_env():
+    env = CartPoleContEnv()
+    A, B, Q, R = cartpole_lqr.cartpole_lqr_system(env)
+    np.random.seed(0)
+    gains = cartpole_lqr.lqr_gain(env) * cartpole_lqr.sample_modifiers('chaotic', (8, 4))
+    batch_env = BatchCartPoleContEnv(8)
+    batch_env.seed(list(range(8)))
+    batch = cartpole_lqr.run_controller_batch(batch_env, 100, BatchLQR(gains, actionBounds=[-1.0, 1.0]))
+    for m in range(8):
+        env.seed(m)
+        logs = run_controller(env, horizon=100, policy=LQR(A, B, Q, R, actionBounds=[-1.0, 1.0], K=gains[m:m + 1]))
+        assert len(logs.states) == batch.lengths[m]
+        np.testing.assert_array_equal(np.reshape(logs.states, (-1, 4)), batch.states[m, :len(logs.states)])
+        np.testing.assert_array_equal(np.ravel(logs.actions), batch.actions[m, :len(logs.states)])
+
+
+@pytest.mark.parametrize('data_mode', ['normal', 'chaotic', 'unstable'])
+def test_batch_collection_matches_sequential(data_mode):
+    cfg = OmegaConf.create({'env': {'name': 'Cartpole-v0'}, 'num_trials': 20, 'trial_timesteps': 100,
+                            'data_mode': data_mode, 'PID_test': False, 'video': False})
+    np.random.seed(1)
+    sequential = cartpole_lqr.collect_data_lqr(cfg)
+    after_sequential = np.random.rand()
+    np.random.seed(1)
+    batch = cartpole_lqr.collect_data_lqr_batch(cfg)
+    assert np.random.rand() == after_sequential
+    assert len(batch) == len(sequential) == cfg.num_trials
+    for s, b in zip(sequential, batch):
+        np.testing.assert_array_equal(s.K, b.K)
+        np.testing.assert_array_equal(s.states, b.states)
+        np.testing.assert_array_equal(np.ravel(s.actions), b.actions)
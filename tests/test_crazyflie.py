@@ -0,0 +1,58 @@
+import numpy as np
+import pytest
+
+from envs.crazyflie import CrazyFlieEnv, integrator_error
+
+
+def test_single_state_derivative_matches_array():
+    env = CrazyFlieEnv()
+    env.seed(0)
+    rng = np.random.RandomState(0)
+    x = np.concatenate([np.zeros((5, 3)), rng.uniform(-0.5, 0.5, size=(5, 9))], axis=1)
+    u = env.pwm_thrust_torque(16383 + rng.uniform(-2000, 2000, size=(4, 5))).T
+    batch = env.state_derivative(x, u)
+    for m in range(5):
+        np.testing.assert_allclose(env.state_derivative(x[m], u[m]), batch[m], rtol=1e-12, atol=1e-12)
+
+
+@pytest.mark.parametrize('integrator', ['euler', 'semi-implicit', 'rk4'])
+def test_single_step_matches_integrate(integrator):
+    env = CrazyFlieEnv(x_noise=0, integrator=integrator)
+    env.seed(0)
+    env.reset()
+    x = env.state.copy()
+    pwm = np.array([17000, 16000, 16500, 15800])
+    env.step(pwm)
+    expected = env.integrate(x[None], env.pwm_thrust_torque(pwm)[None])[0]
+    np.testing.assert_allclose(env.state, expected, rtol=1e-12, atol=1e-12)
+
+
+def test_rk4_more_accurate_than_euler():
+    err, ref_err = integrator_error('rk4', substeps=2, num_envs=20)
+    assert np.all(err <= ref_err)
+    assert np.max(err) < 1e-5
+    err, ref_err = integrator_error('euler', substeps=10, num_envs=20)
+    np.testing.assert_array_equal(err, ref_err)
+
+
+def test_batch_env_matches_env():
+    crazyflie_pd = pytest.importorskip('crazyflie_pd')
+    from omegaconf import OmegaConf
+    from envs.crazyflie import BatchCrazyFlieEnv
+    pid = OmegaConf.load('conf/envs/crazyflie.yaml').pid
+    rng = np.random.RandomState(0)
+    P = 100 + rng.rand(6, 2) * 10000
+    D = 10 + rng.rand(6, 2) * 50000
+    batch_env = BatchCrazyFlieEnv(6, x_noise=0)
+    batch_env.seed(list(range(6)))
+    batch = crazyflie_pd.run_controller_batch(batch_env, 100, crazyflie_pd.BatchPidPolicy(P, D, pid))
+    env = CrazyFlieEnv(x_noise=0)
+    for m in range(6):
+        env.seed(m)
+        policy = crazyflie_pd.PidPolicy([[P[m, 0], 0, D[m, 0]], [P[m, 1], 0, D[m, 1]]], pid)
+        logs = crazyflie_pd.run_controller(env, horizon=100, policy=policy)
+        assert len(logs.states) == batch.lengths[m]
+        np.testing.assert_allclose(np.reshape(logs.states, (-1, 9)), batch.states[m, :len(logs.states)],
+                                   rtol=1e-6, atol=1e-9)
+        np.testing.assert_allclose(np.reshape(logs.actions, (-1, 4)), batch.actions[m, :len(logs.states)],
+                                   rtol=1e-6)
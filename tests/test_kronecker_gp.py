@@ -0,0 +1,68 @@
+import numpy as np
+import pytest
+import torch
+from omegaconf import OmegaConf
+
+dynamics_model = pytest.importorskip('dynamics_model')
+
+
+def make_gp():
+    cfg = OmegaConf.create({'model': {'training': {'state_indices': [0, 1], 'num_traj': 0, 'kron_iters': 20,
+                                                   'kron_lr': .05}}})
+    return dynamics_model.KroneckerGP(4, 2, cfg, None)
+
+
+def trajectories(N=6, T=8, seed=0):
+    rng = np.random.RandomState(seed)
+    X, Y = [], []
+    for n in range(N):
+        s0, p = rng.uniform(-1, 1, size=2), rng.uniform(-1, 1)
+        for t in range(1, T + 1):
+            X.append([s0[0], s0[1], t, p])
+            Y.append([s0[0] * np.cos(.3 * t * p), s0[1] + .1 * t * p])
+    return np.array(X), np.array(Y)
+
+
+def dense_posterior(gp, x):
+    # exact GP posterior with the full (N T) x (N T) kernel matrix K_c (x) K_t
+    cache = gp._cache
+    K_c = dynamics_model._matern52(cache['C'], cache['C'], gp.lengthscale_c).numpy()
+    K_t = (gp.signal * dynamics_model._matern52(cache['times'], cache['times'], gp.lengthscale_t)).numpy()
+    N, T = len(K_c), len(K_t)
+    Y = ((gp.grid(*gp._data)[2] - gp.y_mean) / gp.y_std).reshape(N * T, -1)
+    c = torch.from_numpy((np.delete(x, gp.index_col, axis=1) - gp.c_mean) / gp.c_std)
+    t = torch.from_numpy(x[:, [gp.index_col]] / gp.t_scale)
+    k = (dynamics_model._matern52(c, cache['C'], gp.lengthscale_c)[:, :, None] *
+         (gp.signal * dynamics_model._matern52(t, cache['times'], gp.lengthscale_t))[:, None, :]).numpy()
+    k = k.reshape(len(x), N * T)
+    K = np.kron(K_c, K_t) + gp.noise.item() * np.eye(N * T)
+    mean = k @ np.linalg.solve(K, Y) * gp.y_std + gp.y_mean
+    var = gp.signal.item() - np.sum(k * np.linalg.solve(K, k.T).T, axis=1) + gp.noise.item()
+    return mean, var.reshape(-1, 1) * gp.y_std ** 2
+
+
+def test_forward_matches_dense_gp():
+    X, Y = trajectories()
+    gp = make_gp()
+    gp.optimize((X, Y), None)
+    x = X[::5] + np.array([.05, -.05, .5, .05])
+    mean, var = dense_posterior(gp, x)
+    out = gp.forward(x)
+    np.testing.assert_allclose(out[:, :2], mean, rtol=1e-6, atol=1e-8)
+    np.testing.assert_allclose(out[:, 2:], var, rtol=1e-6, atol=1e-8)
+
+
+def test_update_refits_on_all_points():
+    X, Y = trajectories()
+    gp = make_gp()
+    gp.optimize((X[:40], Y[:40]), None)
+    gp.update(X[40:], Y[40:])
+    reference = make_gp()
+    reference.optimize((X, Y), None)
+    x = X[::7] + .1
+    np.testing.assert_allclose(gp.forward(x), reference.forward(x))
+
+
+def test_update_needs_optimize():
+    with pytest.raises(ValueError):
+        make_gp().update(np.zeros((1, 4)), np.zeros((1, 2)))
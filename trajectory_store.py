@@ -0,0 +1,140 @@
+"""
+Append-only storage of collected trajectories, so a collection run keeps every finished trial on disk as it goes
+instead of only saving the whole dataset at the end.
+
+A store is two files: path holds the pickled trajectories (DotMaps with the arrays and control parameters) one
+after the other, and path.idx has a "trial offset length" line per trajectory. A trajectory only counts once its
+index line is written, both files are flushed and synced after every trajectory, so after a crash the store holds
+every trial finished before it and a partially written trajectory is ignored (and cut off when resuming).
+The store only exists for the duration of a collection: once the finished dataset is saved, remove() deletes it.
+It makes collection crash-safe and resumable, it does not lower peak memory: the collectors still read every
+trajectory back to save the dataset as one file.
+"""
+
+import os
+import pickle
+
+
+def read_index(path):
+    """
+    :return: a dict from trial to the (offset, length) of its record, for the complete index lines of path.idx
+    """
+    index = {}
+    if not os.path.exists(path + '.idx'):
+        return index
+    with open(path + '.idx') as f:
+        for line in f:
+            if not line.endswith('\n'):
+                break
+            trial, offset, length = (int(v) for v in line.split())
+            index[trial] = (offset, length)
+    return index
+
+
+def read_trajectories(path):
+    """
+    Reads the trajectories of a store in trial order, also while it is still being written
+    :return: an array of DotMaps
+    """
+    index = read_index(path)
+    logs = []
+    with open(path, 'rb') as f:
+        for trial in sorted(index):
+            offset, length = index[trial]
+            f.seek(offset)
+            logs.append(pickle.loads(f.read(length)))
+    return logs
+
+
+class TrajectoryWriter(object):
+    def __init__(self, path, resume=False):
+        """
+        :param path: file of the trajectories, the index is written to path + '.idx'
+        :param resume: keep the trajectories of an earlier, interrupted run at path (see trials), otherwise
+                       the store starts empty
+        """
+        self.path = path
+        self.index = read_index(path) if resume else {}
+        end = max([o + l for o, l in self.index.values()], default=0)
+        # anything after the last indexed trajectory was cut off by a crash
+        self._data = open(path, 'r+b' if resume and os.path.exists(path) else 'wb')
+        self._data.truncate(end)
+        self._data.seek(end)
+        self._index = open(path + '.idx', 'a' if resume else 'w')
+        if resume:
+            # drop a partially written last index line
+            with open(path + '.idx', 'rb') as f:
+                self._index.truncate(f.read().rfind(b'\n') + 1)
+        self._sync()
+
+    @property
+    def trials(self):
+        """The trials already in the store, collection only needs to run the others"""
+        return set(self.index)
+
+    def __len__(self):
+        return len(self.index)
+
+    def append(self, trial, dotmap):
+        """
+        Writes the trajectory of a finished trial to disk
+        """
+        record = pickle.dumps(dotmap, protocol=pickle.HIGHEST_PROTOCOL)
+        offset = self._data.tell()
+        self._data.write(record)
+        self._data.flush()
+        os.fsync(self._data.fileno())
+        self._index.write('%d %d %d\n' % (trial, offset, len(record)))
+        self._sync()
+        self.index[trial] = (offset, len(record))
+
+    def read(self):
+        """
+        :return: an array of DotMaps of every trajectory in the store, in trial order
+        """
+        return read_trajectories(self.path)
+
+    def close(self):
+        self._data.close()
+        self._index.close()
+
+    def remove(self):
+        """
+        Closes the store and deletes both of its files, once its trajectories are saved elsewhere
+        """
+        self.close()
+        for path in (self.path, self.path + '.idx'):
+            if os.path.exists(path):
+                os.remove(path)
+
+    def _sync(self):
+        self._index.flush()
+        os.fsync(self._index.fileno())
+
+
+class TrajectoryList(object):
+    """
+    In memory stand-in for TrajectoryWriter, for collecting without a store
+    """
+
+    def __init__(self):
+        self.logs = {}
+
+    @property
+    def trials(self):
+        return set(self.logs)
+
+    def __len__(self):
+        return len(self.logs)
+
+    def append(self, trial, dotmap):
+        self.logs[trial] = dotmap
+
+    def read(self):
+        return [self.logs[trial] for trial in sorted(self.logs)]
+
+    def close(self):
+        pass
+
+    def remove(self):
+        pass